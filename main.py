@@ -40,14 +40,23 @@ from google.appengine.ext.webapp.util import run_wsgi_app
 
 # The following are necessary for full-text search demo
 import search
+import search.handlers
 INDEXING_URL = '/tasks/searchindexing'
+HOT_QUERIES_URL = '/tasks/hotqueries'
+ORPHAN_SWEEP_URL = '/tasks/orphansweep'
+COMPACTION_URL = '/tasks/compaction'
 
 class Page(search.Searchable, db.Model):
     user = db.UserProperty()
     title = db.StringProperty()
     content = db.TextProperty()
-    created = db.DateTimeProperty(auto_now=True)
+    created = db.DateTimeProperty(auto_now_add=True)
+    updated = db.DateTimeProperty(auto_now=True)
     INDEX_TITLE_FROM_PROP = 'title'
+    INDEX_STORED_FIELDS = ['user', 'created']
+    INDEX_VERSION_FROM_PROP = 'updated'
+    INDEX_SORT_PROP = 'created'
+    INDEX_FILTER_PROPS = ['user']
     # INDEX_USES_MULTI_ENTITIES = False
 
 class SimplePage(webapp.RequestHandler):
@@ -84,10 +93,15 @@ class SimplePage(webapp.RequestHandler):
             page += ' value="%s">' % (phrase)
         page += '<input type="submit" name="submitbtn" value="Return Pages">'
         page += '<input type="submit" name="submitbtn" value="Return Keys Only">'
+        page += '<label><input type="checkbox" name="mine" value="1"'
+        if self.request.get('mine'):
+            page += ' checked'
+        page += '>My pages only</label>'
         page += """
         <p><strong>Return Pages</strong> retrieves the entire Page entities.<br />
            <strong>Return Keys Only</strong> retrieves just the keys but uses
-           intelligent key naming to transmit "Title" data via the key names.</p>
+           intelligent key naming to transmit "Title", "User" and "Created"
+           data via the key names.</p>
         """
         page += '</form>'
         page += html
@@ -137,21 +151,31 @@ class SearchPage(SimplePage):
         submitbtn = self.request.get('submitbtn')
         phrase = self.request.get('phrase')
         html = "<h4>'" + phrase + "' was found on these pages:</h4>"
+        filters = None
+        if self.request.get('mine'):
+            filters = [('user =', users.get_current_user())]
         if submitbtn == 'Return Keys Only':
-            key_list = Page.search(phrase, keys_only=True)
-            for key_and_title in key_list:
-                html += "<div><p>Title: %s</p></div>" % key_and_title[1]
+            results = Page.search(phrase, stored_only=True, order='-created',
+                                  filters=filters)
+            for result in results:
+                html += "<div><p>Title: %s</p><p>User: %s, Created: %s</p></div>" \
+                        % (result.title, str(result.user), str(result.created))
         else:
-            pages = Page.search(phrase)
+            pages = Page.search(phrase, order='-created', filters=filters)
+            matcher = Page.get_snippet_matcher(phrase)
             for page in pages:
-                html += "<div><p>Title: %s</p><p>User: %s, Created: %s</p><pre>%s</pre></div>" \
-                        % (page.title, str(page.user), str(page.created), cgi.escape(page.content))
+                snippets = page.get_snippets(matcher, prop_names=['content'])
+                html += "<div><p>Title: %s</p><p>User: %s, Created: %s</p><p>%s</p></div>" \
+                        % (page.title, str(page.user), str(page.created), '<br />'.join(snippets))
         self.render(html)
 
 application = webapp.WSGIApplication([
         ('/', MainPage),
         ('/search', SearchPage),
-        (INDEXING_URL, search.SearchIndexing)], debug=True)
+        (INDEXING_URL, search.handlers.SearchIndexing),
+        (HOT_QUERIES_URL, search.handlers.HotQueryRefresh),
+        (ORPHAN_SWEEP_URL, search.handlers.OrphanSweep),
+        (COMPACTION_URL, search.handlers.ShardCompaction)], debug=True)
 
 def main():
     run_wsgi_app(application)
@@ -35,37 +35,65 @@ SearchableModel implementation.
 """
 __author__ = 'William T. Katz'
 
+import datetime
+import hashlib
 import logging
 import re
 import string
 import sys
+import time
+import urllib
 
 from google.appengine.api import datastore
 from google.appengine.api import datastore_types
+from google.appengine.api import users
 from google.appengine.ext import db
-from google.appengine.ext import webapp
-
-# TODO -- This will eventually be moved out of labs namespace
-from google.appengine.api.labs import taskqueue
-
-# Use python port of Porter2 stemmer.
-from search.pyporter2 import Stemmer
 
+# The webapp handlers (search.handlers), the Task Queue API and the Porter2
+# stemmer are imported on first use so instances that only serve searches
+# or only run indexing tasks don't pay for them at cold start.
 class Error(Exception):
     """Base search module error type."""
 
 class IndexTitleError(Error):
     """Raised when INDEX_TITLE_FROM_PROP or title alterations are incorrect."""
 
+class StoredFieldsError(Error):
+    """Raised when INDEX_STORED_FIELDS can't be packed into an index key name."""
+
+class IndexSortError(Error):
+    """Raised when a sorted search doesn't match the model's INDEX_SORT_PROP."""
+
+class IndexFilterError(Error):
+    """Raised when a search filter doesn't name one of INDEX_FILTER_PROPS."""
+
 # Following module-level constants are cached in instance
 
 KEY_NAME_DELIMITER = '||'  # Used to hold arbitrary strings in key names.
                            # Should not be contained in derived class key names.
 
+STORED_FIELDS_MARKER = '@'   # Starts the key name fragment of stored fields.
+STORED_FIELDS_SCHEMA_TAG = 'v'  # Starts the tag of the stored field names.
+STORED_FIELDS_SEPARATOR = ','
+
+MAX_KEY_NAME_LENGTH = 500
+
 MAX_ENTITY_SEARCH_PHRASES = datastore._MAX_INDEXED_PROPERTIES - 1
 
+MAX_PUT_BATCH_BYTES = 900 * 1024    # Under the 1 MB limit of a datastore request.
+
+FILTER_PROP_PREFIX = 'filter_'  # Index entity property names of INDEX_FILTER_PROPS
+
+SHARD_FILL_FACTOR = 0.95    # Target fill of index entities spread by hash.
+
 SEARCH_PHRASE_MIN_LENGTH = 4
 
+FACET_COUNT_LIMIT = 1000    # Cap on the index entities counted per facet.
+
+DERIVED_STOP_WORDS_TTL = 60 # Seconds between checks for newly derived stop words.
+
+MIGRATION_CHECK_TTL = 60    # Seconds between checks for finished index migrations.
+
 STOP_WORDS = frozenset([
  'a', 'about', 'according', 'accordingly', 'affected', 'affecting', 'after',
  'again', 'against', 'all', 'almost', 'already', 'also', 'although',
@@ -100,25 +128,416 @@ STOP_WORDS = frozenset([
 
 PUNCTUATION_REGEX = re.compile('[' + re.escape(string.punctuation) + ']')
 
+_stemmer = None
+
+def get_stemmer():
+    """Returns the instance-wide English stemmer, loading it on first use."""
+    global _stemmer
+    if _stemmer is None:
+        # Use python port of Porter2 stemmer.
+        from search.pyporter2 import Stemmer
+        _stemmer = Stemmer.Stemmer('english')
+    return _stemmer
+
+class AnalyzerProfile(object):
+    """Settings that turn text into the search phrases of a Searchable kind.
+
+    Indexing and searching of a kind use the same profile, set with the
+    INDEX_ANALYZER class variable, so words dropped from indexes are also
+    dropped from search phrases.
+
+    Args:
+        stop_words: Set of lowercase words that are never indexed.
+        min_length: Shortest single word that is indexed.
+        max_words: Longest indexed phrase, from 1 to 3 words.  Only used
+            with INDEX_MULTI_WORD.
+        name: String.  If given, stop words derived from document
+            frequencies by search.analyzers.derive_stop_words() under this
+            name are added to stop_words.  Their version is checked at most
+            every DERIVED_STOP_WORDS_TTL seconds, so indexing and searching
+            on every instance switch to new stop words within that time.
+
+    >>> profile = AnalyzerProfile(stop_words=['lorem'], min_length=3)
+    >>> profile.get_keywords('Lorem ipsum, or not.')
+    ['ipsum', 'not']
+    """
+    def __init__(self, stop_words=STOP_WORDS,
+                 min_length=SEARCH_PHRASE_MIN_LENGTH, max_words=3, name=None):
+        self.stop_words = frozenset(stop_words)
+        self.min_length = min_length
+        self.max_words = max_words
+        self.name = name
+        self.reset()
+
+    def get_stop_words(self):
+        """Returns the stop words, including any derived ones."""
+        if not self.name:
+            return self.stop_words
+        now = time.time()
+        if (self._all_stop_words is None or
+                now - self._checked > DERIVED_STOP_WORDS_TTL):
+            from search import analyzers
+            version = analyzers.get_derived_stop_words_version(self.name)
+            if self._all_stop_words is None or version != self._version:
+                self._all_stop_words = (self.stop_words |
+                                        analyzers.get_derived_stop_words(self.name))
+                self._version = version
+            self._checked = now
+        return self._all_stop_words
+
+    def reset(self):
+        """Forgets derived stop words, so they are read again on next use."""
+        self._all_stop_words = None
+        self._version = None
+        self._checked = 0
+
+    def get_keywords(self, text):
+        """Returns the words of text that are indexed on their own, in order."""
+        stop_words = self.get_stop_words()
+        return [word for word in PUNCTUATION_REGEX.sub(' ', text).lower().split()
+                if word not in stop_words and len(word) >= self.min_length]
+
+DEFAULT_ANALYZER = AnalyzerProfile()
+
+def get_kind_analyzer(kind=None):
+    """Returns the AnalyzerProfile of a Searchable kind name.
+
+    Searches that aren't restricted to a kind use DEFAULT_ANALYZER.  The
+    model of kind must be imported, since its profile may differ from the
+    default; otherwise db.KindError is raised.
+    """
+    if kind:
+        model_class = db.class_for_kind(kind)
+        if hasattr(model_class, 'get_analyzer'):
+            return model_class.get_analyzer()
+    return DEFAULT_ANALYZER
+
+ALL_KINDS_GENERATION = '*'      # Generation bumped by indexing of any kind.
+GENERATION_SEED_SHIFT = 42      # Bits of a generation counted after each seed.
+
+class GenerationSeed(db.Model):
+    """Counts reseeds of the kind generations kept in memcache."""
+    count = db.IntegerProperty(default=0)
+
+def _generation_cache_key(kind):
+    return 'search-generation' + KEY_NAME_DELIMITER + (kind or ALL_KINDS_GENERATION)
+
+def _get_generation_seed():
+    """Returns a generation above any handed out before the last reseed.
+
+    Seeds are a datastore counter shifted by GENERATION_SEED_SHIFT, so
+    they only repeat values if a kind is bumped 2**42 times between two
+    evictions.  The shift also puts them above the millisecond clock
+    values that earlier versions seeded generations with.
+    """
+    def increment():
+        seed = GenerationSeed.get_by_key_name('seed')
+        if seed is None:
+            seed = GenerationSeed(key_name='seed')
+        seed.count += 1
+        seed.put()
+        return seed.count
+    return db.run_in_transaction(increment) << GENERATION_SEED_SHIFT
+
+def get_kind_generation(kind=None):
+    """Returns an opaque token that changes whenever indexes of a kind change.
+
+    Generations live in memcache.  If a counter is evicted, it is reseeded
+    from _get_generation_seed() so that it never repeats a value handed
+    out earlier, which means an eviction can only cause extra refreshes,
+    never stale results.
+
+    Args:
+        kind: String.  Kind name, or None for the generation of all kinds.
+    """
+    from google.appengine.api import memcache
+    cache_key = _generation_cache_key(kind)
+    generation = memcache.get(cache_key)
+    if generation is None:
+        memcache.add(cache_key, _get_generation_seed())
+        generation = memcache.get(cache_key)
+    return generation
+
+def bump_kind_generation(kind):
+    """Marks the indexes of a kind (and of all kinds) as changed.
+
+    Must be called outside of transactions, since a reseed runs one.
+    """
+    from google.appengine.api import memcache
+    for cache_key in [_generation_cache_key(kind), _generation_cache_key(None)]:
+        if memcache.incr(cache_key) is None:
+            memcache.add(cache_key, _get_generation_seed())
+    from search import postings
+    postings.forget_generation(kind)
+
+def get_phrase_hash(phrase):
+    """Returns a hash of a search phrase that is stable across instances."""
+    if isinstance(phrase, unicode):
+        phrase = phrase.encode('utf-8')
+    return int(hashlib.md5(phrase).hexdigest()[:8], 16)
+
+def get_max_shard_phrases(index_values, dedicated=False):
+    """Returns the phrase capacity of index entities with the given values.
+
+    Only the sort value is combined with phrases in a composite index (see
+    index.yaml), adding a row per phrase; ordered and range-filtered
+    searches use it.  Equality filters on filter values are merge-joined
+    with indexes that don't include phrases, so they don't count.
+    Capacity is divided between the sort value composite index and, unless
+    the index kind is dedicated to one parent kind, the parent_kind
+    composite index.
+    """
+    composites = 0
+    if 'sort_value' in index_values:
+        composites += 1
+    if not dedicated:
+        composites += 1
+    return MAX_ENTITY_SEARCH_PHRASES / max(1, composites)
+
+def partition_phrases(phrases, max_phrases=MAX_ENTITY_SEARCH_PHRASES):
+    """Splits phrases into hash partitions that each fit in an index entity.
+
+    A phrase always lands in the same partition for a given number of
+    partitions, so an edit to the indexed text only changes the partitions
+    holding added or removed phrases.  The number of partitions is the
+    smallest that fills them to SHARD_FILL_FACTOR without any overflowing.
+
+    Returns:
+        A list of sorted phrase lists.  Some partitions may be empty.
+    """
+    if not phrases:
+        return []
+    hashed = [(phrase, get_phrase_hash(phrase)) for phrase in phrases]
+    shard_capacity = int(max_phrases * SHARD_FILL_FACTOR) or 1
+    num_shards = (len(hashed) - 1) / shard_capacity + 1
+    while True:
+        shards = [[] for shard_num in xrange(num_shards)]
+        for phrase, phrase_hash in hashed:
+            shards[phrase_hash % num_shards].append(phrase)
+        if max([len(shard) for shard in shards]) <= max_phrases:
+            break
+        num_shards += 1
+    for shard in shards:
+        shard.sort()
+    return shards
+
+def fetch_queries(queries, limit):
+    """Returns a list with the results of fetching limit from each query.
+
+    SDKs with asynchronous datastore calls (marked by db.get_async) start
+    every query's first batch before reading any of them, so the queries
+    take about one round trip.  Older SDKs fetch them one at a time.
+    """
+    if hasattr(db, 'get_async'):
+        batches = [query.run(limit=limit) for query in queries]
+        return [list(batch) for batch in batches]
+    return [query.fetch(limit) for query in queries]
+
+def get_put_batches(entities, max_bytes=MAX_PUT_BATCH_BYTES):
+    """Splits entities into batches whose encoded size stays under max_bytes.
+
+    An entity larger than max_bytes gets a batch of its own.
+    """
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for entity in entities:
+        entity_bytes = len(db.model_to_protobuf(entity).Encode())
+        if batch and batch_bytes + entity_bytes > max_bytes:
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(entity)
+        batch_bytes += entity_bytes
+    if batch:
+        batches.append(batch)
+    return batches
+
+def put_and_delete(entities, keys):
+    """Puts entities and deletes keys in as few batch calls as fit a request.
+
+    Puts are split by get_put_batches(), so the number of calls grows with
+    the bytes written rather than the number of entities.  SDKs with
+    asynchronous datastore calls issue every call before waiting for any,
+    so writes take about one round trip.
+    """
+    batches = get_put_batches(entities)
+    if hasattr(db, 'put_async'):
+        rpcs = [db.put_async(batch) for batch in batches]
+        if keys:
+            rpcs.append(db.delete_async(keys))
+        for rpc in rpcs:
+            rpc.get_result()
+    else:
+        for batch in batches:
+            db.put(batch)
+        if keys:
+            db.delete(keys)
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def get_microseconds(value=None):
+    """Returns a datetime (default: now) as microseconds since the epoch."""
+    if value is None:
+        value = datetime.datetime.utcnow()
+    elif value.tzinfo is not None:
+        value = value.replace(tzinfo=None) - value.utcoffset()
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def _encode_stored_value(value):
+    """Returns a type-tagged, key name safe string for a property value."""
+    if value is None:
+        encoded = 'n'
+    elif isinstance(value, bool):
+        encoded = 'b' + str(int(value))
+    elif isinstance(value, (int, long)):
+        encoded = 'i' + str(value)
+    elif isinstance(value, float):
+        encoded = 'f' + repr(value)
+    elif isinstance(value, datetime.datetime):
+        encoded = 'd' + str(get_microseconds(value))
+    elif isinstance(value, users.User):
+        # Email, auth domain and, on SDKs that have it, the user id.
+        parts = [value.email(), value.auth_domain()]
+        if hasattr(value, 'user_id') and value.user_id():
+            parts.append(value.user_id())
+        encoded = 'u' + '/'.join([urllib.quote(part.encode('utf-8'), safe='@.')
+                                  for part in parts])
+    elif isinstance(value, db.Key):
+        encoded = 'k' + str(value)
+    elif isinstance(value, basestring):
+        encoded = 's' + value
+    else:
+        raise StoredFieldsError("Can't store a %s in index key names" %
+                                type(value).__name__)
+    if isinstance(encoded, unicode):
+        encoded = encoded.encode('utf-8')
+    return urllib.quote(encoded, safe=" @.:/-_~'")
+
+def _decode_stored_value(encoded):
+    """Inverse of _encode_stored_value()."""
+    encoded = urllib.unquote(str(encoded))
+    tag, value = encoded[:1], encoded[1:]
+    if tag == 'n':
+        return None
+    elif tag == 'b':
+        return value == '1'
+    elif tag == 'i':
+        return int(value)
+    elif tag == 'f':
+        return float(value)
+    elif tag == 'd':
+        return EPOCH + datetime.timedelta(microseconds=long(value))
+    elif tag == 'u':
+        parts = [urllib.unquote(part).decode('utf-8') for part in value.split('/')]
+        kwargs = {}
+        if len(parts) > 1:
+            kwargs['_auth_domain'] = parts[1]
+        if len(parts) > 2:
+            kwargs['_user_id'] = parts[2]
+        return users.User(parts[0], **kwargs)
+    elif tag == 'k':
+        return db.Key(value)
+    else:
+        return value.decode('utf-8')
+
+
+def _escape_key_name_part(text):
+    """Escapes KEY_NAME_DELIMITER characters in a key name fragment."""
+    return text.replace('%', '%25').replace('|', '%7C')
+
+def _unescape_key_name_part(text):
+    """Inverse of _escape_key_name_part()."""
+    return text.replace('%7C', '|').replace('%25', '%')
+
+def _get_stored_fields_tag(stored_fields):
+    """Returns a short tag identifying a list of stored field names."""
+    names = ','.join(stored_fields)
+    return STORED_FIELDS_SCHEMA_TAG + hashlib.md5(names).hexdigest()[:6] + ':'
+
+
+class SearchResult(object):
+    """Lightweight search hit built from an index key name.
+
+    The parent entity is not fetched.  Besides key and title, the values
+    of the model's INDEX_STORED_FIELDS are available as attributes.
+    """
+    def __init__(self, key, title, fields):
+        self.key = key
+        self.title = title
+        self.fields = fields
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['fields'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __repr__(self):
+        return '<SearchResult %s %r>' % (self.key, self.title)
+
+    @classmethod
+    def from_index_key(cls, index_key):
+        key_name = index_key.name()
+        return cls(index_key.parent(), SearchIndex.get_title(key_name),
+                   SearchIndex.get_stored_fields(key_name))
+
+
 # Rather than have an extra property name to distinguish stemmed from
 # non-stemmed index entities, we use different Models that are
 # identical to a base index entity.
-class SearchIndex(db.Model):
+class SearchIndex(db.Expando):
     """Holds full text indexing on an entity.
     
     This model is used by the Searchable mix-in to hold full text
     indexes of a parent entity.
+
+    PARENT_KIND is set on index models dedicated to one parent kind (see
+    get_dedicated_index_class()), which have no parent_kind property.
+
+    Index entities of models declaring INDEX_SORT_PROP get a dynamic
+    sort_value property.  Other index entities don't have it, so they add
+    no rows to the sort_value composite indexes.  Likewise, values of
+    INDEX_FILTER_PROPS are copied to dynamic properties named with
+    FILTER_PROP_PREFIX, e.g. filter_user.
     """
+    PARENT_KIND = None
+
     @staticmethod
     def get_index_key_name(parent, index_num=1):
+        """Returns the key name of an index entity of parent.
+
+        The key name joins the parent's kind and id, index_num, the title
+        and any stored fields with KEY_NAME_DELIMITER.  Delimiter characters
+        in the id and title are escaped.  Stored fields are prefixed by a
+        tag of the INDEX_STORED_FIELDS names, so key names written before
+        the names change aren't decoded with the wrong names.
+        """
         key = parent.key()
         title = key.kind() + ' ' + str(key.id_or_name())
-        uniq_key = title + KEY_NAME_DELIMITER + str(index_num)
+        uniq_key = (_escape_key_name_part(title) + KEY_NAME_DELIMITER +
+                    str(index_num))
         if hasattr(parent, 'INDEX_TITLE_FROM_PROP'):
             logging.debug("Getting key name from property '%s'", parent.INDEX_TITLE_FROM_PROP)
             if hasattr(parent, parent.INDEX_TITLE_FROM_PROP):
                 title = getattr(parent, parent.INDEX_TITLE_FROM_PROP) or title
-        return uniq_key + KEY_NAME_DELIMITER + title
+        key_name = uniq_key + KEY_NAME_DELIMITER + _escape_key_name_part(title)
+        stored_fields = getattr(parent, 'INDEX_STORED_FIELDS', None)
+        if stored_fields:
+            values = []
+            for prop_name in stored_fields:
+                if prop_name not in parent.properties():
+                    raise StoredFieldsError("INDEX_STORED_FIELDS names unknown "
+                                            "property '%s'" % prop_name)
+                values.append(_encode_stored_value(getattr(parent, prop_name)))
+            key_name += (KEY_NAME_DELIMITER + STORED_FIELDS_MARKER +
+                         _get_stored_fields_tag(stored_fields) +
+                         STORED_FIELDS_SEPARATOR.join(values))
+            if len(key_name.encode('utf-8')) > MAX_KEY_NAME_LENGTH:
+                raise StoredFieldsError("Title and INDEX_STORED_FIELDS of %s "
+                                        "exceed %d bytes" % (key, MAX_KEY_NAME_LENGTH))
+        return key_name
 
     @staticmethod
     def get_title(key_name=''):
@@ -126,7 +545,31 @@ class SearchIndex(db.Model):
         if len(frags) < 3:
             return 'Unknown Title'
         else:
-            return frags[2]
+            return _unescape_key_name_part(frags[2])
+
+    @staticmethod
+    def get_stored_fields(key_name=''):
+        """Returns a dict of the INDEX_STORED_FIELDS packed in a key name."""
+        frags = key_name.split(KEY_NAME_DELIMITER)
+        if len(frags) < 4 or not frags[-1].startswith(STORED_FIELDS_MARKER):
+            return {}
+        try:
+            model_class = db.class_for_kind(frags[0].split(' ', 1)[0])
+        except db.KindError:
+            return {}
+        stored_fields = getattr(model_class, 'INDEX_STORED_FIELDS', None)
+        if not stored_fields:
+            return {}
+        packed = frags[-1][len(STORED_FIELDS_MARKER):]
+        if packed.startswith(STORED_FIELDS_SCHEMA_TAG):
+            tag = _get_stored_fields_tag(stored_fields)
+            if not packed.startswith(tag):
+                # Written for other INDEX_STORED_FIELDS; reindex with
+                # force=True to update.
+                return {}
+            packed = packed[len(tag):]
+        values = packed.split(STORED_FIELDS_SEPARATOR)
+        return dict(zip(stored_fields, map(_decode_stored_value, values)))
 
     @staticmethod
     def get_index_num(key_name=''):
@@ -136,25 +579,186 @@ class SearchIndex(db.Model):
         else:
             return frags[1]
 
+    @staticmethod
+    def set_index_num(key_name, index_num):
+        """Returns key_name renumbered to index_num."""
+        frags = key_name.split(KEY_NAME_DELIMITER)
+        frags[1] = str(index_num)
+        return KEY_NAME_DELIMITER.join(frags)
+
     @classmethod
-    def put_index(cls, parent, phrases, index_num=1):
+    def make_index(cls, parent, phrases, index_num=1, version=None):
+        """Returns an unsaved index entity of parent holding phrases."""
         parent_key = parent.key()
         args = {'key_name': cls.get_index_key_name(parent, index_num),
-                'parent': parent_key, 'parent_kind': parent_key.kind(), 
-                'phrases': phrases }
-        return cls(**args).put()
+                'parent': parent_key, 'phrases': phrases, 'version': version }
+        if cls.PARENT_KIND is None:
+            args['parent_kind'] = parent_key.kind()
+        if hasattr(parent, 'get_index_values'):
+            args.update(parent.get_index_values())
+        return cls(**args)
+
+    @classmethod
+    def put_index(cls, parent, phrases, index_num=1, version=None):
+        return cls.make_index(parent, phrases, index_num, version).put()
 
 
 class LiteralIndex(SearchIndex):
     """Index model for non-inflected search phrases."""
     parent_kind = db.StringProperty(required=True)
     phrases = db.StringListProperty(required=True)
+    version = db.IntegerProperty()      # Parent version the phrases came from
 
 
 class StemmedIndex(SearchIndex):
     """Index model for stemmed (inflected) search phrases."""
     parent_kind = db.StringProperty(required=True)
     phrases = db.StringListProperty(required=True)
+    version = db.IntegerProperty()      # Parent version the phrases came from
+
+
+_dedicated_index_classes = {}
+
+def get_dedicated_index_class(kind, stemming=True):
+    """Returns the index model used only by one Searchable kind.
+
+    The model is made on first use and named after the kind, e.g.
+    PageStemmedIndex.  Searches of the kind filter it on phrases only, so
+    they need no composite index and entities have no parent_kind.
+    """
+    name = str(kind) + (stemming and 'StemmedIndex' or 'LiteralIndex')
+    index_class = _dedicated_index_classes.get(name)
+    if index_class is None:
+        index_class = type(name, (SearchIndex,), {
+            '__doc__': 'Index model dedicated to %s entities.' % kind,
+            '__module__': __name__,
+            'PARENT_KIND': kind,
+            'STEMMING': stemming,
+            'phrases': db.StringListProperty(required=True),
+            'version': db.IntegerProperty()})
+        _dedicated_index_classes[name] = index_class
+    return index_class
+
+def get_dedicated_index_classes():
+    """Returns the dedicated index models made so far, ordered by kind name.
+
+    A model is made, and so registered, by the first get_index_class() call
+    of its Searchable kind in this process.  Processes that only run
+    maintenance should call load_dedicated_index_classes() instead.
+    """
+    return [index_class for name, index_class
+            in sorted(_dedicated_index_classes.items())]
+
+
+class DedicatedIndexRecord(db.Model):
+    """Records a dedicated index model that index entities were written to.
+
+    The key name is the index kind name.  Lets maintenance find the model
+    in processes that never imported its Searchable kind.
+    """
+    parent_kind = db.StringProperty(required=True)
+    stemming = db.BooleanProperty(required=True)
+
+_recorded_index_classes = set()
+
+def record_dedicated_index_class(index_class):
+    """Stores a DedicatedIndexRecord for a dedicated index model once."""
+    name = index_class.kind()
+    if name not in _recorded_index_classes:
+        DedicatedIndexRecord.get_or_insert(name,
+                                           parent_kind=index_class.PARENT_KIND,
+                                           stemming=index_class.STEMMING)
+        _recorded_index_classes.add(name)
+
+def load_dedicated_index_classes():
+    """Returns the dedicated index models recorded by any process.
+
+    Models are made from their DedicatedIndexRecord entities, so their
+    Searchable kinds don't have to be imported.
+    """
+    for record in DedicatedIndexRecord.all().fetch(1000):
+        get_dedicated_index_class(record.parent_kind, record.stemming)
+    return get_dedicated_index_classes()
+
+def get_search_index_class(kind=None, stemming=True):
+    """Returns the index model searched for a kind name.
+
+    Searches that aren't restricted to a kind, or restricted to a kind
+    without INDEX_DEDICATED, use the shared StemmedIndex or LiteralIndex.
+    The model of kind must be imported to tell which; otherwise
+    db.KindError is raised.
+    """
+    if kind:
+        model_class = db.class_for_kind(kind)
+        if getattr(model_class, 'INDEX_DEDICATED', False):
+            return model_class.get_index_class()
+    return stemming and StemmedIndex or LiteralIndex
+
+
+class DedicatedIndexMigration(db.Model):
+    """Marks the index entities of a kind as moved to its dedicated model.
+
+    The key name is the kind name.  Until it exists, searches of a kind
+    with INDEX_DEDICATED read the shared index model as well.  Written by
+    search.maintenance.migrate_to_dedicated() when the last batch is done.
+    """
+    completed = db.DateTimeProperty(auto_now_add=True)
+
+_migrated_kinds = set()
+_migration_checks = {}
+
+def is_migration_complete(kind):
+    """Returns True if a kind's dedicated index migration is marked complete.
+
+    Completion is final, so it is remembered by the instance.  Otherwise
+    the marker is read at most every MIGRATION_CHECK_TTL seconds.
+    """
+    if kind in _migrated_kinds:
+        return True
+    now = time.time()
+    if now - _migration_checks.get(kind, 0) > MIGRATION_CHECK_TTL:
+        _migration_checks[kind] = now
+        if DedicatedIndexMigration.get_by_key_name(kind):
+            _migrated_kinds.add(kind)
+            return True
+    return False
+
+def mark_migration_complete(kind):
+    """Records that a kind's index entities are all in its dedicated model."""
+    DedicatedIndexMigration(key_name=kind).put()
+    _migrated_kinds.add(kind)
+
+def get_search_index_classes(kind=None, stemming=True):
+    """Returns the index models searched for a kind name.
+
+    Like get_search_index_class(), but while a kind with INDEX_DEDICATED
+    isn't marked as migrated (see is_migration_complete()) the shared
+    index model is searched after the dedicated one, so entities not yet
+    migrated are still found.
+    """
+    index_class = get_search_index_class(kind, stemming)
+    if index_class.PARENT_KIND is None or is_migration_complete(kind):
+        return [index_class]
+    return [index_class, stemming and StemmedIndex or LiteralIndex]
+
+
+class IndexHead(db.Model):
+    """Latest parent version written to an index kind.
+
+    Child of the indexed entity, so it shares an entity group with the
+    index entities and index() can check and update it transactionally.
+    The key name is the index kind name.  Index entities whose phrases
+    didn't change keep the version they were written with, so shards
+    lists the index numbers making up the current index.
+    """
+    version = db.IntegerProperty(required=True)
+    shards = db.ListProperty(int)
+    updated = db.DateTimeProperty(auto_now=True)
+
+    @staticmethod
+    def get_key(index_class, parent_key):
+        return db.Key.from_path(IndexHead.kind(), index_class.kind(),
+                                parent=parent_key)
 
 
 class Searchable(object):
@@ -181,6 +785,12 @@ class Searchable(object):
     useful labels on key-only searches without doing a get() on the whole 
     entity.
 
+    Other small properties can be packed into index key names by listing
+    them in INDEX_STORED_FIELDS, e.g. ['user', 'created'].  Searches with
+    stored_only=True then return SearchResult records carrying the key,
+    title and stored values without fetching the entities.  Title and
+    stored values must fit together in MAX_KEY_NAME_LENGTH bytes.
+
     Defaults are for searches to use stemming, multiple index entities,
     and index all basestring-derived properties.  Also, two and three-word
     phrases are inserted into the index, which can be disable by setting
@@ -210,24 +820,62 @@ class Searchable(object):
         myPage.enqueue_indexing(url='/tasks/searchindexing')
 
     Note that a url must be included that corresponds with the url mapped
-    to search.LiteralIndexing controller.
+    to the search.handlers.SearchIndexing controller.
 
     You can limit the properties indexed by passing in a list of 
     property names:
 
         myPage.enqueue_indexing(url='/foo', only_index=['content'])
 
+    Indexing skips entities whose version (see INDEX_VERSION_FROM_PROP)
+    was already indexed.  After changing how a kind is indexed, e.g. its
+    INDEX_SORT_PROP, INDEX_FILTER_PROPS, INDEX_STORED_FIELDS or derived
+    stop words, reindex its entities with force=True:
+
+        myPage.enqueue_indexing(url='/tasks/searchindexing', force=True)
+
     If you want to risk getting a timeout during indexing, you could
     index immediately after putting your model and forego task queueing:
 
         myPage.put()
         myPage.index()
 
+    Searches can be ordered by a property named in INDEX_SORT_PROP, which
+    is copied onto the index entities:
+
+        Page.search('stuff', order='-created')  # -> Newest Pages first
+
+    The ordering is done by the index query, using the sort_value composite
+    indexes in index.yaml, so it costs no more than an unordered search.
+
+    Properties listed in INDEX_FILTER_PROPS are copied onto the index
+    entities too, so searches can be restricted by them in the same query:
+
+        Page.search('stuff', filters=[('user =', user)])
+        Page.search('stuff', filters=[('created >', yesterday)])
+
+    Equality filters are merge-joined with the phrases.  Range filters are
+    only allowed on INDEX_SORT_PROP (here 'created'), so like ordered
+    searches they merge-join the sort_value composite indexes of each
+    keyword and each filter property.  Index entities of
+    models with an INDEX_SORT_PROP hold MAX_ENTITY_SEARCH_PHRASES / 2
+    phrases (see get_max_shard_phrases()).
+
+    Deleting an entity with its delete() method also removes its index
+    entities through unindex().
+
     After your model has been indexed, you may use the search() method:
 
         Page.search('search phrase')          # -> Returns Page entities
         Page.search('stuff', keys_only=True)  # -> Returns Page keys
 
+    Rather than sending whole entities to users, you can show highlighted
+    snippets of the text around matches:
+
+        matcher = Page.get_snippet_matcher('search phrase')
+        for page in Page.search('search phrase'):
+            snippets = page.get_snippets(matcher, prop_names=['content'])
+
     In the case of multi-word search phrases like the first example above,
     the search will first list keys that match the full phrase and then
     list keys that match the AND of individual keywords.  Note that when
@@ -243,6 +891,31 @@ class Searchable(object):
 
     Because stemming can be toggled for any particular Model, only entities will
     be returned that match indexing style (i.e., stemming on or off).
+
+    Stop words, the minimum word length and the longest indexed phrase can be
+    set per Model with an AnalyzerProfile.  Its stop words can be extended
+    with words found in most of your entities (see search.analyzers):
+
+        INDEX_ANALYZER = search.AnalyzerProfile(min_length=3, name='pages')
+
+    Index entities of all kinds share the StemmedIndex and LiteralIndex
+    models, so searches of one kind filter on parent_kind, which needs the
+    composite indexes in index.yaml.  Setting INDEX_DEDICATED to True gives
+    the kind an index model of its own, e.g. PageStemmedIndex, searched on
+    built-in indexes alone.  Its entities aren't found by full_text_search()
+    without a kind.  Existing index entities can be moved with
+    search.maintenance.migrate_to_dedicated().
+
+    To search a few kinds at once and show how many matches each has, use
+    multi_kind_search():
+
+        results, facets = Searchable.multi_kind_search('stuff', ['Page', 'Comment'])
+
+    Frequent searches are sampled and the most popular ones are answered from
+    precomputed results (see search.hotqueries) once the HotQueryRefresh
+    handler in search.handlers is run periodically from cron.  Each instance
+    also caches the postings of frequently searched terms (see
+    search.postings) and intersects them in memory.
     """
 
     INDEX_ONLY = None           # Can set to list of property names to index.
@@ -253,16 +926,46 @@ class Searchable(object):
     # indexed properties limit (MAX_ENTITY_SEARCH_PHRASES)
     INDEX_USES_MULTI_ENTITIES = True
 
+    # Property holding the content version, e.g. a DateTimeProperty with
+    # auto_now=True.  If None, indexing runs are ordered by time of indexing.
+    INDEX_VERSION_FROM_PROP = None
+
+    # Property copied to index entities so searches can be ordered by it.
+    INDEX_SORT_PROP = None
+
+    # Properties copied to index entities so searches can be filtered by them.
+    INDEX_FILTER_PROPS = None
+
+    # AnalyzerProfile used to index and search this kind, or DEFAULT_ANALYZER.
+    INDEX_ANALYZER = None
+
+    # If True, index entities go in a model of their own instead of the
+    # shared StemmedIndex or LiteralIndex.  Call get_index_class() after
+    # the class definition to register the model for maintenance.
+    INDEX_DEDICATED = False
+
     @staticmethod
     def full_text_search(phrase, limit=10, 
                          kind=None, 
                          stemming=INDEX_STEMMING,
-                         multi_word_literal=INDEX_MULTI_WORD):
+                         multi_word_literal=INDEX_MULTI_WORD,
+                         use_hot_queries=True,
+                         filters=None):
         """Queries search indices for phrases using a merge-join.
         
         Args:
             phrase: String.  Search phrase.
             kind: String.  Returned keys/entities are restricted to this kind.
+                Without a kind, only the shared index models are searched,
+                so kinds with INDEX_DEDICATED aren't found.
+            use_hot_queries: Boolean.  If True, the search is sampled for
+                search.hotqueries and answered from materialized results
+                when the phrase is hot.
+            filters: List of (condition, value) tuples.  Equality filters
+                are on INDEX_FILTER_PROPS, e.g. [('user =', user)], range
+                filters on the INDEX_SORT_PROP of kind, e.g.
+                [('created >', yesterday)].  Applied by the index query, so
+                filtered searches aren't hot queries.
 
         Returns:
             A list of (key, title) tuples corresponding to the indexed entities.  
@@ -270,56 +973,362 @@ class Searchable(object):
 
         TODO -- Should provide feedback if input search phrase has stop words, etc.
         """
+        index_keys = Searchable.search_index_keys(
+                        phrase, limit=limit, kind=kind, stemming=stemming,
+                        multi_word_literal=multi_word_literal,
+                        use_hot_queries=use_hot_queries, filters=filters)
+        return [(key.parent(), SearchIndex.get_title(key.name())) for key in index_keys]
+
+    @staticmethod
+    def multi_kind_search(phrase, kinds, limit=10,
+                          stemming=INDEX_STEMMING,
+                          multi_word_literal=INDEX_MULTI_WORD,
+                          filters=None,
+                          facet_limit=FACET_COUNT_LIMIT):
+        """Searches several kinds at once and counts the matches of each.
+
+        The per-kind index queries are fetched together (see fetch_queries())
+        and the results interleaved kind by kind, with literal multi-word
+        matches of all kinds before keyword matches, up to limit.
+
+        Args:
+            phrase: String.  Search phrase.
+            kinds: List of kind names, e.g. [Page.kind(), Comment.kind()].
+            facet_limit: Integer.  Most matches counted for any kind.
+
+        Returns:
+            A (results, facets) tuple.  Results is a list of (key, title)
+            tuples like full_text_search() returns.  Facets is a dict of
+            kind name to number of matching index entities, which is
+            approximate: entities whose index spans several shards may be
+            counted more than once, and counts stop at facet_limit.  Only
+            kinds with limit or more keyword matches need counting, by
+            keys-only fetches of up to facet_limit run together.
+        """
+        index_filters = Searchable.get_index_filters(filters)
+        # Kinds being migrated to a dedicated index model read both models.
+        targets = [(kind, index_class) for kind in kinds
+                   for index_class in get_search_index_classes(kind, stemming)]
+        queries = [Searchable.get_index_queries(
+                       phrase, kind=kind, stemming=stemming,
+                       multi_word_literal=multi_word_literal,
+                       index_filters=index_filters,
+                       analyzer=get_kind_analyzer(kind),
+                       index_class=index_class) for kind, index_class in targets]
+        literal_keys = [[] for target in targets]
+        literal_queries = [(num, literal_query) for num, (literal_query, keyword_query)
+                           in enumerate(queries) if literal_query]
+        batches = fetch_queries([query for num, query in literal_queries], limit)
+        for (num, query), batch in zip(literal_queries, batches):
+            literal_keys[num] = batch
+        keyword_keys = [[] for target in targets]
+        exhausted = [not keyword_query for literal_query, keyword_query in queries]
+        keyword_queries = [(num, keyword_query) for num, (literal_query, keyword_query)
+                           in enumerate(queries)
+                           if keyword_query and len(literal_keys[num]) < limit]
+        batches = fetch_queries([query for num, query in keyword_queries], limit)
+        for (num, query), batch in zip(keyword_queries, batches):
+            keyword_keys[num] = [key for key in batch if key not in literal_keys[num]]
+            exhausted[num] = len(batch) < limit
+
+        index_keys = []
+        parent_keys = set()
+        for kind_keys in (literal_keys, keyword_keys):
+            for rank in xrange(limit):
+                for keys in kind_keys:
+                    if rank < len(keys) and keys[rank].parent() not in parent_keys:
+                        parent_keys.add(keys[rank].parent())
+                        index_keys.append(keys[rank])
+        results = [(key.parent(), SearchIndex.get_title(key.name()))
+                   for key in index_keys[:limit]]
+
+        counted = {}
+        count_nums = [num for num in xrange(len(targets)) if not exhausted[num]]
+        batches = fetch_queries([queries[num][1] for num in count_nums], facet_limit)
+        for num, batch in zip(count_nums, batches):
+            counted[num] = len(batch)
+        facets = dict([(kind, 0) for kind in kinds])
+        for num, (kind, index_class) in enumerate(targets):
+            found = len(literal_keys[num]) + len(keyword_keys[num])
+            found = max(found, counted.get(num, 0))
+            facets[kind] = min(facets[kind] + found, facet_limit)
+        return results, facets
+
+    @staticmethod
+    def get_index_filters(filters, sort_prop=None):
+        """Returns filters translated to index entity property conditions.
+
+        Equality filters apply to INDEX_FILTER_PROPS values.  Range filters
+        apply to the sort value, so they must be on the INDEX_SORT_PROP of
+        the searched kind, given as sort_prop.  The datastore merge-joins
+        the (phrases, sort_value) and (filter property, sort_value)
+        composite indexes for them, whatever the number of keywords.  Other
+        range filters would need a composite index per combination of
+        filter properties, and raise IndexFilterError.
+        """
+        index_filters = []
+        for condition, value in filters or []:
+            frags = condition.split(None, 1)
+            operator = len(frags) > 1 and frags[1].strip() or '='
+            if operator not in ('=', '<', '<=', '>', '>='):
+                raise IndexFilterError("Unsupported filter operator '%s'" % operator)
+            if operator == '=':
+                prop_name = FILTER_PROP_PREFIX + frags[0]
+            elif sort_prop and frags[0] == sort_prop:
+                prop_name = 'sort_value'
+            else:
+                raise IndexFilterError("Range filters must be on the INDEX_SORT_PROP "
+                                       "of the searched kind, not '%s'" % frags[0])
+            index_filters.append((prop_name + ' ' + operator, value))
+        return index_filters
+
+    @staticmethod
+    def search_index_keys(phrase, limit=10,
+                          kind=None,
+                          stemming=INDEX_STEMMING,
+                          multi_word_literal=INDEX_MULTI_WORD,
+                          use_hot_queries=True,
+                          sort_order=None,
+                          filters=None,
+                          use_postings=True,
+                          index_class=None):
+        """Returns keys of the index entities matching phrases.
+
+        Takes the same arguments as full_text_search().  The parent of each
+        index key is the matched entity and its name holds the title and
+        stored fields (see SearchIndex.get_title() and get_stored_fields()).
+
+        The index models searched default to get_search_index_classes().
+        When it returns two, i.e. during a migration to a dedicated index
+        model, each is searched and the results merged by parent entity.
+
+        If sort_order is 'asc' or 'desc', keys are returned in order of the
+        INDEX_SORT_PROP values copied to the index entities of kind.  The
+        ordering is done by the index query, so only limit keys are read.
+
+        If use_postings is True, unfiltered searches of a kind intersect the
+        postings of hot terms cached by search.postings in memory and only
+        query the datastore for the other terms.
+        """
+        if sort_order and not kind:
+            raise IndexSortError('Sorted searches must be restricted to a kind')
+        sort_prop = None
+        if kind and filters:
+            sort_prop = getattr(db.class_for_kind(kind), 'INDEX_SORT_PROP', None)
+        index_filters = Searchable.get_index_filters(filters, sort_prop)
+        if use_hot_queries and not sort_order and not index_filters:
+            from search import hotqueries
+            hotqueries.sample(phrase, kind, stemming, multi_word_literal)
+            hot_results = hotqueries.lookup(phrase, limit, kind, stemming,
+                                            multi_word_literal)
+            if hot_results is not None:
+                return hot_results
+
+        if kind and index_class is None:
+            index_classes = get_search_index_classes(kind, stemming)
+            if len(index_classes) > 1:
+                return Searchable.merge_index_keys(
+                    [Searchable.search_index_keys(
+                         phrase, limit, kind, stemming, multi_word_literal,
+                         use_hot_queries=False, sort_order=sort_order,
+                         filters=filters, use_postings=use_postings,
+                         index_class=klass) for klass in index_classes],
+                    limit, sort_order)
+        elif not kind and _dedicated_index_classes:
+            logging.warning("Search for '%s' without a kind skips kinds with "
+                            "dedicated index models", phrase)
+
+        if sort_order:
+            # One keyword AND query, sorted by the datastore.  Literal
+            # multi-word matches aren't listed first since that would
+            # break the ordering.
+            literal_query, query = Searchable.get_index_queries(
+                phrase, kind=kind, stemming=stemming, multi_word_literal=False,
+                index_filters=index_filters, analyzer=get_kind_analyzer(kind),
+                index_class=index_class)
+            if not query:
+                return []
+            query = query.order(sort_order == 'desc' and '-sort_value' or 'sort_value')
+            index_keys = []
+            parent_keys = set()
+            for key in query.fetch(limit=limit):
+                # Entities indexed by several shards may match more than once.
+                if key.parent() not in parent_keys:
+                    parent_keys.add(key.parent())
+                    index_keys.append(key)
+            return index_keys
+
+        def fetch_matches(terms, fetch_limit):
+            if use_postings and kind and not index_filters:
+                from search import postings
+                klass = index_class or get_search_index_class(kind, stemming)
+                index_keys = postings.get_index_keys(klass, kind, terms, fetch_limit)
+                if index_keys is not None:
+                    return index_keys
+            query = Searchable.get_index_query(terms, kind, stemming, index_filters,
+                                               index_class)
+            return query.fetch(limit=fetch_limit)
+
+        index_keys = []
+        literal_terms, keyword_terms = Searchable.get_index_terms(
+            phrase, stemming=stemming, multi_word_literal=multi_word_literal,
+            analyzer=get_kind_analyzer(kind))
+        if literal_terms:
+            # Try to match literal multi-word phrases first
+            index_keys = fetch_matches(literal_terms, limit)
+
+        if len(index_keys) < limit and keyword_terms:
+            new_limit = limit - len(index_keys)
+            single_word_matches = [key for key in fetch_matches(keyword_terms, new_limit) \
+                                   if key not in index_keys]
+            index_keys.extend(single_word_matches)
+
+        return index_keys
+
+    @staticmethod
+    def merge_index_keys(results, limit, sort_order=None):
+        """Merges lists of index keys from several index models.
+
+        Keys keep the order of results, or the order of their sort values
+        if sort_order is given, and only the first key of each parent
+        entity is kept.
+        """
         index_keys = []
+        for keys in results:
+            index_keys.extend(keys)
+        if sort_order:
+            # Sort values are only on the index entities themselves.
+            decorated = [(entity.sort_value, key) for key, entity
+                         in zip(index_keys, db.get(index_keys)) if entity]
+            decorated.sort(reverse=(sort_order == 'desc'))
+            index_keys = [key for sort_value, key in decorated]
+        merged = []
+        parent_keys = set()
+        for key in index_keys:
+            if key.parent() not in parent_keys:
+                parent_keys.add(key.parent())
+                merged.append(key)
+        return merged[:limit]
+
+    @staticmethod
+    def get_index_queries(phrase, kind=None,
+                          stemming=INDEX_STEMMING,
+                          multi_word_literal=INDEX_MULTI_WORD,
+                          index_filters=(),
+                          analyzer=DEFAULT_ANALYZER,
+                          index_class=None):
+        """Returns keys-only index queries for the literal and keyword matches.
+
+        Args:
+            index_filters: Conditions from get_index_filters().
+            analyzer: AnalyzerProfile the searched kinds were indexed with.
+                Its stop words and short words are left out of the queries.
+            index_class: Index model queried, see get_index_query().
+
+        Returns:
+            A (literal_query, keyword_query) tuple.  The literal query
+            matches multi-word phrases and is None unless phrase has more
+            than one word and multi_word_literal is True.  The keyword
+            query matches the AND of individual keywords.  Either is None
+            when there's nothing to match, e.g. only stop words.
+        """
+        literal_terms, keyword_terms = Searchable.get_index_terms(
+            phrase, stemming=stemming, multi_word_literal=multi_word_literal,
+            analyzer=analyzer)
+        return (Searchable.get_index_query(literal_terms, kind, stemming,
+                                           index_filters, index_class),
+                Searchable.get_index_query(keyword_terms, kind, stemming,
+                                           index_filters, index_class))
+
+    @staticmethod
+    def get_index_query(terms, kind=None, stemming=INDEX_STEMMING, index_filters=(),
+                        index_class=None):
+        """Returns a keys-only query for index entities with all terms.
+
+        The index model defaults to get_search_index_class(kind, stemming).
+        Returns None if there are no terms.
+        """
+        if not terms:
+            return None
+        klass = index_class or get_search_index_class(kind, stemming)
+        query = klass.all(keys_only=True)
+        for term in terms:
+            query = query.filter('phrases =', term)
+        if kind and klass.PARENT_KIND is None:
+            query = query.filter('parent_kind =', kind)
+        for condition, value in index_filters:
+            query = query.filter(condition, value)
+        return query
+
+    @staticmethod
+    def get_index_terms(phrase, stemming=INDEX_STEMMING,
+                        multi_word_literal=INDEX_MULTI_WORD,
+                        analyzer=DEFAULT_ANALYZER):
+        """Returns the index phrases searched for a search phrase.
+
+        Returns:
+            A (literal_terms, keyword_terms) tuple of lists.  The literal
+            terms are multi-word phrases, the keyword terms single words.
+        """
         keywords = PUNCTUATION_REGEX.sub(' ', phrase).lower().split()
         if stemming:
-            stemmer = Stemmer.Stemmer('english')
-            klass = StemmedIndex
-        else:
-            klass = LiteralIndex
+            stemmer = get_stemmer()
 
-        if len(keywords) > 1 and multi_word_literal:
-            # Try to match literal multi-word phrases first
+        literal_terms = []
+        stop_words = analyzer.get_stop_words()
+        if len(keywords) > 1 and multi_word_literal and analyzer.max_words > 1:
+            keyword_not_stop_word = map(lambda x: x not in stop_words, keywords)
             if len(keywords) == 2:
-                search_phrases = [' '.join(keywords)]
+                literal_terms = [' '.join(keywords)]
+            elif analyzer.max_words == 2:
+                for pos in xrange(0, len(keywords) - 1):
+                    if keyword_not_stop_word[pos] and keyword_not_stop_word[pos+1]:
+                        literal_terms.append(' '.join(keywords[pos:pos+2]))
             else:
-                search_phrases = []
                 sub_strings = len(keywords) - 2
-                keyword_not_stop_word = map(lambda x: x not in STOP_WORDS, keywords)
                 for pos in xrange(0, sub_strings):
                     if keyword_not_stop_word[pos] and keyword_not_stop_word[pos+2]:
-                        search_phrases.append(' '.join(keywords[pos:pos+3]))
-            query = klass.all(keys_only=True)
-            for phrase in search_phrases:
-                if stemming:
-                    phrase = stemmer.stemWord(phrase)
-                query = query.filter('phrases =', phrase)
-            if kind:
-                query = query.filter('parent_kind =', kind)
-            index_keys = query.fetch(limit=limit)
-
-        if len(index_keys) < limit:
-            new_limit = limit - len(index_keys)
-            keywords = filter(lambda x: len(x) >= SEARCH_PHRASE_MIN_LENGTH, keywords)
+                        literal_terms.append(' '.join(keywords[pos:pos+3]))
             if stemming:
-                keywords = stemmer.stemWords(keywords)
-            query = klass.all(keys_only=True)
-            for keyword in keywords:
-                query = query.filter('phrases =', keyword)
-            if kind:
-                query = query.filter('parent_kind =', kind)
-            single_word_matches = [key for key in query.fetch(limit=new_limit) \
-                                   if key not in index_keys]
-            index_keys.extend(single_word_matches)
+                literal_terms = [stemmer.stemWord(x) for x in literal_terms]
 
-        return [(key.parent(), SearchIndex.get_title(key.name())) for key in index_keys]
+        keyword_terms = analyzer.get_keywords(phrase)
+        if stemming:
+            keyword_terms = stemmer.stemWords(keyword_terms)
+        return literal_terms, keyword_terms
+
+    @classmethod
+    def get_index_class(cls):
+        """Returns the index model holding this kind's index entities."""
+        if cls.INDEX_DEDICATED:
+            return get_dedicated_index_class(cls.kind(), cls.INDEX_STEMMING)
+        return cls.INDEX_STEMMING and StemmedIndex or LiteralIndex
+
+    @classmethod
+    def get_unmigrated_index_class(cls):
+        """Returns the shared index model still searched for this kind.
+
+        Only kinds with INDEX_DEDICATED whose migration isn't complete
+        (see is_migration_complete()) have one, else None is returned.
+        Index entities left in it are searched alongside the dedicated
+        model, so index() and unindex_key() delete them.
+        """
+        if not cls.INDEX_DEDICATED or is_migration_complete(cls.kind()):
+            return None
+        return cls.INDEX_STEMMING and StemmedIndex or LiteralIndex
+
+    @classmethod
+    def get_analyzer(cls):
+        """Returns the AnalyzerProfile used to index and search this kind."""
+        return cls.INDEX_ANALYZER or DEFAULT_ANALYZER
 
     @classmethod
-    def get_simple_search_phraseset(cls, text):
+    def get_simple_search_phraseset(cls, text, analyzer=None):
         """Returns a simple set of keywords from given text.
 
         Args:
             text: String.
+            analyzer: AnalyzerProfile.  Defaults to the class's profile.
 
         Returns:
             A set of keywords that aren't stop words and meet length requirement.
@@ -329,19 +1338,13 @@ class Searchable(object):
         """
         if text:
             datastore_types.ValidateString(text, 'text', max_len=sys.maxint)
-            text = PUNCTUATION_REGEX.sub(' ', text)
-            words = text.lower().split()
-            words = set(words)
-            words -= STOP_WORDS
-            for word in list(words):
-                if len(word) < SEARCH_PHRASE_MIN_LENGTH:
-                    words.remove(word)
+            words = set((analyzer or cls.get_analyzer()).get_keywords(text))
         else:
             words = set()
         return words
 
     @classmethod
-    def get_search_phraseset(cls, text):
+    def get_search_phraseset(cls, text, analyzer=None):
         """Returns set of phrases, including two and three adjacent word phrases 
            not spanning punctuation or stop words.
 
@@ -352,7 +1355,8 @@ class Searchable(object):
             A set of search terms that aren't stop words and meet length 
             requirement.  Set includes phrases of adjacent words that
             aren't stop words.  (Stop words are allowed in middle of three-word
-            phrases like "Statue of Liberty".)
+            phrases like "Statue of Liberty".)  The stop words, length and
+            longest phrase come from analyzer, or the class's profile.
 
         >>> Searchable.get_search_phraseset('You look through rosy-colored glasses.')
         set(['look through rosy', 'rosy colored', 'colored', 'colored glasses', 'rosy', 'rosy colored glasses', 'glasses', 'look'])
@@ -363,6 +1367,8 @@ class Searchable(object):
         """
         if text:
             datastore_types.ValidateString(text, 'text', max_len=sys.maxint)
+            analyzer = analyzer or cls.get_analyzer()
+            stop_words = analyzer.get_stop_words()
             text = text.lower()
             phrases = []
             two_words = []
@@ -377,18 +1383,20 @@ class Searchable(object):
                     two_words = []
                     three_words = ['', '']
                 three_words.append(word)  # We allow stop words in middle
-                if word in STOP_WORDS:
+                if word in stop_words:
                     two_words = []
                     three_words_no_stop.append(False)
                 else:
                     two_words.append(word)
                     three_words_no_stop.append(True)
-                    if len(word) >= SEARCH_PHRASE_MIN_LENGTH:
+                    if len(word) >= analyzer.min_length:
                         phrases.append(word)
                     if len(two_words) == 2:
-                        phrases.append(' '.join(two_words))
+                        if analyzer.max_words >= 2:
+                            phrases.append(' '.join(two_words))
                         del two_words[0]
-                    if len(three_words) == 3 and three_words_no_stop[0]:
+                    if (len(three_words) == 3 and three_words_no_stop[0] and
+                            analyzer.max_words >= 3):
                         phrases.append(' '.join(three_words))
                 del three_words[0]
                 del three_words_no_stop[0]
@@ -398,7 +1406,8 @@ class Searchable(object):
         return phrases
 
     @classmethod
-    def search(cls, phrase, limit=10, keys_only=False):
+    def search(cls, phrase, limit=10, keys_only=False, stored_only=False,
+               order=None, filters=None):
         """Queries search indices for phrases using a merge-join.
         
         Use of this class method lets you easily restrict searches to a kind
@@ -408,37 +1417,111 @@ class Searchable(object):
             phrase: Search phrase (string)
             limit: Number of entities or keys to return.
             keys_only: If True, return only keys with title of parent entity.
+            stored_only: If True, return SearchResult records holding the
+                key, title and INDEX_STORED_FIELDS values of parent entities.
+            order: Name of the INDEX_SORT_PROP property, prefixed by '-' for
+                descending order, e.g. '-created'.  Results are sorted by
+                the index query instead of in memory.
+            filters: List of (condition, value) tuples on INDEX_FILTER_PROPS,
+                e.g. [('user =', user)], or range conditions on
+                INDEX_SORT_PROP, e.g. [('created >', yesterday)].  Applied
+                by the index query.
         
         Returns:
             A list.  If keys_only is True, the list holds (key, title) tuples.
-            If keys_only is False, the list holds Model instances.
+            If stored_only is True, the list holds SearchResult instances.
+            Otherwise, the list holds Model instances.
         """
-        key_list = Searchable.full_text_search(
+        sort_order = None
+        if order:
+            if order.lstrip('-') != cls.INDEX_SORT_PROP:
+                raise IndexSortError("Can only order %s searches by INDEX_SORT_PROP"
+                                     " '%s'" % (cls.kind(), cls.INDEX_SORT_PROP))
+            sort_order = order.startswith('-') and 'desc' or 'asc'
+        for condition, value in filters or []:
+            frags = condition.split(None, 1)
+            is_range = len(frags) > 1 and frags[1].strip() != '='
+            if not is_range and frags[0] not in (cls.INDEX_FILTER_PROPS or []):
+                raise IndexFilterError("Can only filter %s searches by "
+                                       "INDEX_FILTER_PROPS, not '%s'"
+                                       % (cls.kind(), frags[0]))
+        index_keys = Searchable.search_index_keys(
                         phrase, limit=limit, kind=cls.kind(),
                         stemming=cls.INDEX_STEMMING, 
-                        multi_word_literal=cls.INDEX_MULTI_WORD)
+                        multi_word_literal=cls.INDEX_MULTI_WORD,
+                        sort_order=sort_order, filters=filters)
         if keys_only:
+            key_list = [(key.parent(), SearchIndex.get_title(key.name()))
+                        for key in index_keys]
             logging.debug("key_list: %s", key_list)
             return key_list
+        elif stored_only:
+            return [SearchResult.from_index_key(key) for key in index_keys]
         else:
-            return [cls.get(key_and_title[0]) for key_and_title in key_list]
+            # Skip entities deleted without unindex(); OrphanSweep removes
+            # their index entities.
+            entities = cls.get([key.parent() for key in index_keys])
+            return [entity for entity in entities if entity is not None]
+
+    @classmethod
+    def get_snippet_matcher(cls, phrase):
+        """Returns a search.snippets.PhraseMatcher for phrase.
+
+        Build the matcher once per search and pass it to get_snippets() for
+        each of the returned entities.
+        """
+        from search import snippets
+        return snippets.PhraseMatcher(phrase, stemming=cls.INDEX_STEMMING,
+                                      analyzer=cls.get_analyzer())
+
+    def get_snippets(self, matcher, prop_names=None, max_snippets=3, length=200):
+        """Returns highlighted snippets of this entity's text around matches.
+
+        Args:
+            matcher: A PhraseMatcher from get_snippet_matcher() or a phrase.
+            prop_names: List of property names to take text from.  Defaults
+                to INDEX_ONLY or, if that is None, all string properties.
+            max_snippets: Maximum number of snippets returned.
+            length: Approximate number of characters per snippet.
+
+        Returns:
+            A list of HTML-escaped strings with matches wrapped in <b> tags.
+        """
+        if isinstance(matcher, basestring):
+            matcher = self.get_snippet_matcher(matcher)
+        prop_names = prop_names or self.INDEX_ONLY
+        texts = []
+        for prop_name, prop_value in self.properties().iteritems():
+            if (not prop_names) or (prop_name in prop_names):
+                value = getattr(self, prop_name)
+                if (isinstance(value, basestring) and
+                        not isinstance(value, datastore_types.Blob)):
+                    texts.append(value)
+        return matcher.get_snippets(texts, max_snippets=max_snippets,
+                                    length=length)
 
     def indexed_title_changed(self):
-        """Renames index entities for this model to match new title."""
-        klass = StemmedIndex if self.INDEX_STEMMING else LiteralIndex
+        """Renames index entities for this model to match new title and stored fields."""
+        klass = self.get_index_class()
         query = klass.all(keys_only=True).ancestor(self.key())
         old_index_keys = query.fetch(1000)
-        if not hasattr(self, 'INDEX_TITLE_FROM_PROP'):
-            raise IndexTitleError('Must declare a property name via INDEX_TITLE_FROM_PROP')
+        if not (hasattr(self, 'INDEX_TITLE_FROM_PROP') or
+                getattr(self, 'INDEX_STORED_FIELDS', None)):
+            raise IndexTitleError('Must declare a property name via INDEX_TITLE_FROM_PROP'
+                                  ' or INDEX_STORED_FIELDS')
+        new_indexes = []
         new_keys = []
-        for old_key in old_index_keys:
-            old_index = db.get(old_key)
-            index_num = SearchIndex.get_index_num(old_key.name())
-            index_key = klass.put_index(parent=self, index_num=index_num,
-                                        phrases=old_index.phrases)
-            new_keys.append(index_key)
+        for old_index in db.get(old_index_keys):
+            index_num = SearchIndex.get_index_num(old_index.key().name())
+            new_indexes.append(klass.make_index(parent=self, index_num=index_num,
+                                                phrases=old_index.phrases,
+                                                version=old_index.version))
+            new_keys.append(db.Key.from_path(
+                klass.kind(), klass.get_index_key_name(self, index_num),
+                parent=self.key()))
         delete_keys = filter(lambda key: key not in new_keys, old_index_keys)
-        db.delete(delete_keys)
+        put_and_delete(new_indexes, delete_keys)
+        bump_kind_generation(self.kind())
 
     def get_search_phrases(self, indexing_func=None):
         """Returns search phrases from properties in a given Model instance.
@@ -464,90 +1547,267 @@ class Searchable(object):
             else:
                 indexing_func = klass.get_simple_search_phraseset
         if self.INDEX_STEMMING:
-            stemmer = Stemmer.Stemmer('english')
+            stemmer = get_stemmer()
         phrases = set()
+        for value in self.get_indexed_texts():
+            words = indexing_func(value)
+            if self.INDEX_STEMMING:
+                stemmed_words = set(stemmer.stemWords(words))
+                phrases.update(stemmed_words)
+            else:
+                phrases.update(words)
+        return list(phrases)
+
+    def get_indexed_texts(self):
+        """Returns a list of the string values of the indexed properties."""
+        texts = []
         for prop_name, prop_value in self.properties().iteritems():
             if (not self.INDEX_ONLY) or (prop_name in self.INDEX_ONLY):
                 values = prop_value.get_value_for_datastore(self)
                 if not isinstance(values, list):
                     values = [values]
-                if (isinstance(values[0], basestring) and
+                if (values and isinstance(values[0], basestring) and
                         not isinstance(values[0], datastore_types.Blob)):
-                    for value in values:
-                        words = indexing_func(value)
-                        if self.INDEX_STEMMING:
-                            stemmed_words = set(stemmer.stemWords(words))
-                            phrases.update(stemmed_words)
-                        else:
-                            phrases.update(words)
-        return list(phrases)
+                    texts.extend(values)
+        return texts
 
-    def index(self, indexing_func=None):
+    def get_index_values(self):
+        """Returns a dict of the dynamic properties of index entities.
+
+        Holds the INDEX_SORT_PROP value as sort_value and INDEX_FILTER_PROPS
+        values under FILTER_PROP_PREFIX names.
+        """
+        values = {}
+        if self.INDEX_SORT_PROP:
+            values['sort_value'] = getattr(self, self.INDEX_SORT_PROP)
+        for prop_name in self.INDEX_FILTER_PROPS or []:
+            if prop_name not in self.properties():
+                raise IndexFilterError("INDEX_FILTER_PROPS names unknown "
+                                       "property '%s'" % prop_name)
+            values[FILTER_PROP_PREFIX + prop_name] = getattr(self, prop_name)
+        return values
+
+    def get_index_version(self):
+        """Returns the version of this instance's content, or None.
+
+        The version is taken from the property named by INDEX_VERSION_FROM_PROP,
+        which should be an integer or a DateTimeProperty with auto_now=True.
+        """
+        prop_name = getattr(self, 'INDEX_VERSION_FROM_PROP', None)
+        if not prop_name:
+            return None
+        value = getattr(self, prop_name)
+        if isinstance(value, datetime.datetime):
+            value = get_microseconds(value)
+        return value
+
+    def index(self, indexing_func=None, version=None, force=False):
         """Generates or replaces a search entities for a Model instance.
 
         Args (optional):
             indexing_func: A function that returns a set of keywords or phrases.
+            version: Integer.  Version of the indexed content.  Defaults to
+                get_index_version() or, failing that, the current time in
+                microseconds.  Callers that fetch the entity should pass a
+                timestamp taken before the fetch.
+            force: If True, reindex even when this version was already indexed.
 
         Note that the indexing_func can be passed in to allow more customized
         search phrase generation.
-        """
-        search_phrases = self.get_search_phrases(indexing_func=indexing_func)
 
+        Index entities are written in one transaction with an IndexHead
+        entity recording the version.  A run for an older version than the
+        recorded one writes nothing, so concurrent indexing of the same
+        entity always leaves the index of the newest version.  Only index
+        entities whose phrases or index values changed are rewritten.
+
+        Changed index entities and the IndexHead are put in batches capped
+        by request size (see put_and_delete()) and stale index entities
+        deleted in another.  With asynchronous
+        datastore calls (see fetch_queries()), the version check runs while
+        phrases are extracted, the transaction reads the IndexHead and
+        previous index entities together, and the put and delete overlap.
+
+        For kinds with INDEX_DEDICATED that aren't migrated yet, index
+        entities left in the shared index model are deleted in the same
+        transaction (see get_unmigrated_index_class()).
+
+        Returns:
+            True if the index was written, False if this version is stale
+            or, unless forced, already indexed.
+        """
         key = self.key()
-        klass = StemmedIndex if self.INDEX_STEMMING else LiteralIndex
+        klass = self.get_index_class()
+        if klass.PARENT_KIND is not None:
+            record_dedicated_index_class(klass)
+        unmigrated_class = self.get_unmigrated_index_class()
+        if version is None:
+            version = self.get_index_version()
+        if version is None:
+            version = get_microseconds()
+        head_key = IndexHead.get_key(klass, key)
+        use_async = hasattr(db, 'get_async')
+        if not force and use_async:
+            head_rpc = db.get_async(head_key)
+        elif not force:
+            head = db.get(head_key)
+            if head and head.version >= version:
+                logging.debug("Index of %s is at version %d, skipping %d",
+                              key, head.version, version)
+                return False
 
+        search_phrases = self.get_search_phrases(indexing_func=indexing_func)
+        if not force and use_async:
+            head = head_rpc.get_result()
+            if head and head.version >= version:
+                logging.debug("Index of %s is at version %d, skipping %d",
+                              key, head.version, version)
+                return False
+
+        index_values = self.get_index_values()
+        max_phrases = get_max_shard_phrases(index_values,
+                                            dedicated=klass.PARENT_KIND is not None)
         if self.__class__.INDEX_USES_MULTI_ENTITIES:
-            query = klass.all(keys_only=True).ancestor(key)
-            previous_index_keys = query.fetch(1000)
-        num_phrases = len(search_phrases)
-
-        start_index = 0
-        entity_num = 1      # Appended to key name of index entity
-        index_keys = []
-        while (num_phrases > 0):
-            cur_num_phrases = min(num_phrases, MAX_ENTITY_SEARCH_PHRASES)
-            end_index = start_index + cur_num_phrases
-            num_indices = (num_phrases - 1) / MAX_ENTITY_SEARCH_PHRASES + 1
-            index_key = klass.put_index(parent=self, index_num=entity_num,
-                                        phrases=search_phrases[start_index:end_index])
-            index_keys.append(index_key)
-            if self.__class__.INDEX_USES_MULTI_ENTITIES:
-                start_index = end_index
-                num_phrases -= cur_num_phrases
-                entity_num += 1
+            shards = partition_phrases(search_phrases, max_phrases)
+        else:
+            # Only write one index entity
+            shards = [search_phrases[:max_phrases]]
+        shard_key_names = [klass.get_index_key_name(self, shard_num + 1)
+                           for shard_num in xrange(len(shards))]
+
+        # Index key names change with the title or stored fields, so
+        # previous index entities may have to be removed even when only
+        # one index entity is used.
+        remove_previous = (self.__class__.INDEX_USES_MULTI_ENTITIES or
+                           hasattr(self, 'INDEX_TITLE_FROM_PROP') or
+                           getattr(self, 'INDEX_STORED_FIELDS', None))
+
+        def write_index():
+            query = klass.all().ancestor(key)
+            if use_async:
+                head_rpc = db.get_async(head_key)
+                if remove_previous:
+                    previous_indexes = query.run(limit=1000)
+                head = head_rpc.get_result()
             else:
-                num_phrases = 0    # Only write one index entity
-        if self.__class__.INDEX_USES_MULTI_ENTITIES:
-            delete_keys = []
-            for key in previous_index_keys:
-                if key not in index_keys:
-                    delete_keys.append(key)
-            db.delete(delete_keys)
+                head = db.get(head_key)
+            if head and head.version > version:
+                return False
+            previous = {}
+            if remove_previous:
+                if not use_async:
+                    previous_indexes = query.fetch(1000)
+                for index in previous_indexes:
+                    previous[index.key().name()] = index
+            index_key_names = []
+            index_nums = []
+            entities = []
+            for shard_num, shard in enumerate(shards):
+                if not shard:
+                    continue
+                entity_num = shard_num + 1      # Appended to key name of index entity
+                key_name = shard_key_names[shard_num]
+                index_key_names.append(key_name)
+                index_nums.append(entity_num)
+                # Hash partitioning keeps most shards unchanged across edits.
+                index = previous.get(key_name)
+                if (index is None or frozenset(index.phrases) != frozenset(shard) or
+                        [name for name, value in index_values.iteritems()
+                         if getattr(index, name, None) != value]):
+                    entities.append(klass.make_index(parent=self, index_num=entity_num,
+                                                     phrases=shard, version=version))
+            entities.append(IndexHead(key_name=klass.kind(), parent=key,
+                                      version=version, shards=index_nums))
+            delete_keys = [index.key() for key_name, index in previous.iteritems()
+                           if key_name not in index_key_names]
+            if unmigrated_class:
+                query = unmigrated_class.all(keys_only=True).ancestor(key)
+                delete_keys += query.fetch(1000)
+                delete_keys.append(IndexHead.get_key(unmigrated_class, key))
+            put_and_delete(entities, delete_keys)
+            return True
+
+        if not db.run_in_transaction(write_index):
+            logging.info("Index of %s is newer than version %d, skipping",
+                         key, version)
+            return False
+        bump_kind_generation(self.kind())
+        return True
+
+    def compact_index(self):
+        """Repacks this instance's index entities into the fewest shards.
+
+        Returns:
+            A dict of statistics, see search.maintenance.compact_index().
+        """
+        from search import maintenance
+        klass = self.get_index_class()
+        return maintenance.compact_index(klass, self.key(),
+                                         self.INDEX_USES_MULTI_ENTITIES)
 
-    def enqueue_indexing(self, url, only_index=None):
+    @classmethod
+    def unindex_key(cls, key):
+        """Deletes the index entities of the entity with the given key.
+
+        Use this when deleting entities by key, e.g. with db.delete().
+        Otherwise the OrphanSweep handler in search.handlers will remove
+        their index entities eventually, and materialized hot queries
+        (see search.hotqueries) list them until their next refresh.
+        Index entities still in the shared index model of a kind being
+        migrated (see get_unmigrated_index_class()) are deleted as well.
+        """
+        from search import hotqueries
+        index_classes = [cls.get_index_class()]
+        unmigrated_class = cls.get_unmigrated_index_class()
+        if unmigrated_class:
+            index_classes.append(unmigrated_class)
+
+        def delete_index():
+            keys = []
+            for index_class in index_classes:
+                query = index_class.all(keys_only=True).ancestor(key)
+                keys += query.fetch(1000) + [IndexHead.get_key(index_class, key)]
+            db.delete(keys)
+
+        db.run_in_transaction(delete_index)
+        bump_kind_generation(key.kind())
+        hotqueries.forget_parent(key)
+
+    def unindex(self):
+        """Deletes the index entities of this Model instance."""
+        self.unindex_key(self.key())
+
+    def delete(self):
+        """Deletes this Model instance and then its index entities."""
+        key = self.key()
+        super(Searchable, self).delete()
+        self.unindex_key(key)
+
+    def enqueue_indexing(self, url, only_index=None, force=False):
         """Adds an indexing task to the default task queue.
         
         Args:
-            url: String. The url associated with LiteralIndexing handler.
+            url: String. The url associated with SearchIndexing handler.
             only_index: List of strings.  Restricts indexing to these prop names.
+            force: If True, the task reindexes even an already indexed version.
         """
         if url:
+            # TODO -- This will eventually be moved out of labs namespace
+            from google.appengine.api.labs import taskqueue
             params = {'key': str(self.key())}
             if only_index:
                 params['only_index'] = ' '.join(only_index)
+            if force:
+                params['force'] = '1'
             taskqueue.add(url=url, params=params)
 
-class SearchIndexing(webapp.RequestHandler):
-    """Handler for full text indexing task."""
-    def post(self):
-        key_str = self.request.get('key')
-        only_index_str = self.request.get('only_index')
-        if key_str:
-            key = db.Key(key_str)
-            entity = db.get(key)
-            if not entity:
-                self.response.set_status(200)   # Clear task because it's a bad key
-            else:
-                only_index = only_index_str.split(',') if only_index_str else None
-                entity.index()
+class SearchIndexing(object):
+    """Deprecated alias of search.handlers.SearchIndexing.
 
+    Kept so existing url mappings to search.SearchIndexing keep working.
+    The webapp handler module is only imported when the first indexing
+    task is handled, so instances that never index don't load webapp.
+    """
+    def __new__(cls, *args, **kwds):
+        from search import handlers
+        return handlers.SearchIndexing(*args, **kwds)
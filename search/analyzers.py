@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+#
+# The MIT License
+# 
+# Copyright (c) 2009 William T. Katz
+# Website/Contact: http://www.billkatz.com
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to 
+# deal in the Software without restriction, including without limitation 
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER 
+# DEALINGS IN THE SOFTWARE.
+
+
+"""Corpus-derived stop words and reports on search.AnalyzerProfile settings.
+
+Words found in most entities of a kind don't narrow searches but are
+written into every index entity.  derive_stop_words() samples a kind,
+measures document frequencies and stores the words above a threshold
+under the name of the kind's AnalyzerProfile, which adds them to its
+stop words.  Each derivation gets a new version, kept in memcache so that
+profiles on every instance can cheaply notice it.  Entities indexed before
+the derivation keep those words until they are reindexed with force=True
+(see Searchable.enqueue_indexing()).
+"""
+__author__ = 'William T. Katz'
+
+import logging
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+import search
+
+STOP_WORD_THRESHOLD = 0.8       # Fraction of entities a derived stop word is in.
+SAMPLE_SIZE = 500               # Entities read to measure document frequencies.
+MIN_SAMPLE_SIZE = 20            # Fewer entities don't give useful frequencies.
+
+
+class DerivedStopWords(db.Model):
+    """Stop words measured for an AnalyzerProfile, keyed by profile name."""
+    words = db.StringListProperty()
+    threshold = db.FloatProperty()
+    sampled = db.IntegerProperty()
+    version = db.IntegerProperty(default=0)
+    updated = db.DateTimeProperty(auto_now=True)
+
+
+def _version_cache_key(name):
+    return 'search-stopwords' + search.KEY_NAME_DELIMITER + name
+
+def get_derived_stop_words_version(name):
+    """Returns the version of the stop words derived under a profile name.
+
+    The version is 0 if none were derived.  It is read from memcache and,
+    on a miss, from the DerivedStopWords entity.
+    """
+    cache_key = _version_cache_key(name)
+    version = memcache.get(cache_key)
+    if version is None:
+        derived = DerivedStopWords.get_by_key_name(name)
+        version = derived and derived.version or 0
+        memcache.add(cache_key, version)
+    return version
+
+def get_derived_stop_words(name):
+    """Returns the frozenset of stop words derived under a profile name."""
+    derived = DerivedStopWords.get_by_key_name(name)
+    if derived is None:
+        return frozenset()
+    return frozenset(derived.words)
+
+def get_document_frequencies(model_class, sample_size=SAMPLE_SIZE):
+    """Returns the fraction of sampled entities containing each word.
+
+    Only words that the kind's AnalyzerProfile would index on their own,
+    ignoring previously derived stop words, are counted.
+
+    Returns:
+        A (frequencies, sampled) tuple of a dict of word to fraction and
+        the number of entities sampled.
+    """
+    analyzer = model_class.get_analyzer()
+    base = search.AnalyzerProfile(stop_words=analyzer.stop_words,
+                                  min_length=analyzer.min_length)
+    counts = {}
+    entities = model_class.all().fetch(sample_size)
+    for entity in entities:
+        words = set()
+        for text in entity.get_indexed_texts():
+            words.update(base.get_keywords(text))
+        for word in words:
+            counts[word] = counts.get(word, 0) + 1
+    sampled = len(entities)
+    frequencies = dict([(word, float(count) / sampled)
+                        for word, count in counts.iteritems()])
+    return frequencies, sampled
+
+def derive_stop_words(model_class, threshold=STOP_WORD_THRESHOLD,
+                      sample_size=SAMPLE_SIZE):
+    """Stores the words in at least threshold of a kind's entities.
+
+    The kind's INDEX_ANALYZER must have a name to store the words under.
+    The profile is reset, so this instance uses the new stop words at once;
+    other instances pick them up within search.DERIVED_STOP_WORDS_TTL
+    seconds.  Reindex the kind with force=True, e.g. through
+    Searchable.enqueue_indexing(), to remove the words from existing index
+    entities; their versions haven't changed, so plain indexing skips them.
+
+    Returns:
+        The set of derived stop words, which is empty if fewer than
+        MIN_SAMPLE_SIZE entities were sampled.
+    """
+    analyzer = model_class.get_analyzer()
+    if not analyzer.name:
+        raise search.Error("INDEX_ANALYZER of %s needs a name to derive stop "
+                           "words" % model_class.__name__)
+    frequencies, sampled = get_document_frequencies(model_class, sample_size)
+    words = set()
+    if sampled >= MIN_SAMPLE_SIZE:
+        words = set([word for word, frequency in frequencies.iteritems()
+                     if frequency >= threshold])
+    version = search.get_microseconds()
+    DerivedStopWords(key_name=analyzer.name, words=sorted(words),
+                     threshold=threshold, sampled=sampled, version=version).put()
+    memcache.set(_version_cache_key(analyzer.name), version)
+    analyzer.reset()
+    logging.info("Derived %d stop words for %s from %d entities: %s",
+                 len(words), model_class.kind(), sampled, ' '.join(sorted(words)))
+    return words
+
+def get_phrase_volume(phrases):
+    """Returns the number of phrases and their size in bytes."""
+    size = 0
+    for phrase in phrases:
+        if isinstance(phrase, unicode):
+            phrase = phrase.encode('utf-8')
+        size += len(phrase)
+    return len(phrases), size
+
+def get_profile_report(model_class, sample_size=SAMPLE_SIZE):
+    """Measures the index volume a kind's AnalyzerProfile removes.
+
+    Search phrases of sampled entities are generated with DEFAULT_ANALYZER
+    and with the kind's profile.
+
+    Returns:
+        A dict with the number of entities 'sampled', the number of
+        'stop_words' of the profile, 'phrases_before' and 'bytes_before'
+        with the default profile, 'phrases_after' and 'bytes_after' with
+        the kind's profile.
+    """
+    analyzer = model_class.get_analyzer()
+    if model_class.INDEX_MULTI_WORD:
+        phraseset_func = model_class.get_search_phraseset
+    else:
+        phraseset_func = model_class.get_simple_search_phraseset
+    report = {'sampled': 0, 'stop_words': len(analyzer.get_stop_words()),
+              'phrases_before': 0, 'bytes_before': 0,
+              'phrases_after': 0, 'bytes_after': 0}
+    for entity in model_class.all().fetch(sample_size):
+        report['sampled'] += 1
+        for suffix, profile in [('before', search.DEFAULT_ANALYZER),
+                                ('after', analyzer)]:
+            phrases = entity.get_search_phrases(
+                indexing_func=lambda text: phraseset_func(text, analyzer=profile))
+            count, size = get_phrase_volume(phrases)
+            report['phrases_' + suffix] += count
+            report['bytes_' + suffix] += size
+    return report
+
+def log_profile_report(kind, report):
+    """Logs the index volume removed by the AnalyzerProfile of a kind."""
+    removed = 0.0
+    if report['bytes_before']:
+        removed = 100.0 * (report['bytes_before'] - report['bytes_after']) / \
+                  report['bytes_before']
+    logging.info("Analyzer profile of %s: %d entities sampled, %d stop words, "
+                 "%d -> %d phrases, %d -> %d bytes (%.1f%% removed)", kind,
+                 report['sampled'], report['stop_words'], report['phrases_before'],
+                 report['phrases_after'], report['bytes_before'],
+                 report['bytes_after'], removed)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+#
+# The MIT License
+# 
+# Copyright (c) 2009 William T. Katz
+# Website/Contact: http://www.billkatz.com
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to 
+# deal in the Software without restriction, including without limitation 
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER 
+# DEALINGS IN THE SOFTWARE.
+
+
+"""Request handlers for the search module's task queue work.
+
+Kept apart from the search package so that importing search (to run or
+serve searches) doesn't pull in webapp.  Map the handlers in your
+WSGIApplication:
+
+    import search.handlers
+    application = webapp.WSGIApplication([
+        ('/tasks/searchindexing', search.handlers.SearchIndexing),
+        ('/tasks/hotqueries', search.handlers.HotQueryRefresh),
+        ('/tasks/orphansweep', search.handlers.OrphanSweep),
+        ('/tasks/compaction', search.handlers.ShardCompaction),
+        ('/tasks/indexmigration', search.handlers.IndexMigration)])
+
+HotQueryRefresh and OrphanSweep should be run periodically from cron.yaml.
+ShardCompaction can be started by hand or from cron after large edits.
+IndexMigration is started by hand for a kind that sets INDEX_DEDICATED,
+e.g. /tasks/indexmigration?kind=Page.
+"""
+__author__ = 'William T. Katz'
+
+from google.appengine.ext import db
+from google.appengine.ext import webapp
+
+import search
+
+class SearchIndexing(webapp.RequestHandler):
+    """Handler for full text indexing task."""
+    def post(self):
+        key_str = self.request.get('key')
+        only_index_str = self.request.get('only_index')
+        force = bool(self.request.get('force'))
+        if key_str:
+            key = db.Key(key_str)
+            # Stamped before the get so a run that reads older content
+            # can't carry a newer version than a run that reads newer content.
+            read_version = search.get_microseconds()
+            entity = db.get(key)
+            if not entity:
+                self.response.set_status(200)   # Clear task because it's a bad key
+            else:
+                only_index = only_index_str.split(',') if only_index_str else None
+                version = entity.get_index_version()
+                if version is None:
+                    version = read_version
+                entity.index(version=version, force=force)
+
+class HotQueryRefresh(webapp.RequestHandler):
+    """Handler for the periodic refresh of materialized hot queries."""
+    def get(self):
+        from search import hotqueries
+        stats = hotqueries.refresh_hot_queries()
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.out.write("hot: %(hot)d, recomputed: %(recomputed)d, "
+                                "dropped: %(dropped)d" % stats)
+
+class IndexScanJob(webapp.RequestHandler):
+    """Base handler for resumable jobs over all index entities.
+
+    A GET (e.g., from cron) starts one task chain per index kind.  Each task
+    processes a batch of index entities in key order and enqueues the next
+    batch, passing along the last key seen and the running totals.
+
+    This class isn't mapped to a url itself.  Each job subclass names the
+    search.maintenance functions doing its work: BATCH_FUNCTION takes a
+    model class and a start key and returns stats including TOTALS and
+    'next_key', and REPORT_FUNCTION takes the kind and the final totals.
+    """
+    TOTALS = ['scanned', 'seconds']
+    BATCH_FUNCTION = None
+    REPORT_FUNCTION = None
+
+    def get_targets(self):
+        """Returns the model classes a GET starts chains for."""
+        from search import maintenance
+        return maintenance.get_index_classes()
+
+    def get_target(self, kind):
+        """Returns the model class a chain for kind works on."""
+        for target in self.get_targets():
+            if target.kind() == kind:
+                return target
+        raise search.Error("Unknown index kind '%s'" % kind)
+
+    def run_batch(self, model_class, start_key):
+        """Processes a batch; returns stats including TOTALS and 'next_key'."""
+        from search import maintenance
+        return getattr(maintenance, self.BATCH_FUNCTION)(model_class, start_key)
+
+    def report(self, kind, totals):
+        """Reports the totals of a finished chain."""
+        from search import maintenance
+        getattr(maintenance, self.REPORT_FUNCTION)(kind, totals)
+
+    def get(self):
+        from google.appengine.api.labs import taskqueue
+        for index_class in self.get_targets():
+            taskqueue.add(url=self.request.path,
+                          params={'kind': index_class.kind()})
+
+    def post(self):
+        from google.appengine.api.labs import taskqueue
+        kind = self.request.get('kind')
+        start_key_str = self.request.get('start_key')
+        start_key = start_key_str and db.Key(start_key_str) or None
+        stats = self.run_batch(self.get_target(kind), start_key)
+        totals = {}
+        for name in self.TOTALS:
+            totals[name] = float(self.request.get(name) or 0) + stats[name]
+        if stats['next_key']:
+            params = dict(totals, kind=kind, start_key=str(stats['next_key']))
+            taskqueue.add(url=self.request.path, params=params)
+        else:
+            self.report(kind, totals)
+
+class OrphanSweep(IndexScanJob):
+    """Handler for the resumable sweep of orphaned index entities."""
+    TOTALS = ['scanned', 'orphans', 'seconds']
+    BATCH_FUNCTION = 'sweep_orphans'
+    REPORT_FUNCTION = 'log_sweep_report'
+
+    def get_targets(self):
+        from search import maintenance
+        return maintenance.get_sweep_classes()
+
+class ShardCompaction(IndexScanJob):
+    """Handler for the resumable compaction of multi-entity indexes."""
+    TOTALS = ['scanned', 'parents', 'entities_reclaimed', 'bytes_reclaimed',
+              'seconds']
+    BATCH_FUNCTION = 'compact_shards'
+    REPORT_FUNCTION = 'log_compaction_report'
+
+class IndexMigration(IndexScanJob):
+    """Handler for moving a kind's index entities to its dedicated model.
+
+    Unlike the other jobs, a GET starts one chain for the kind given by
+    the 'kind' parameter, and each task processes a batch of its entities.
+    """
+    TOTALS = ['scanned', 'migrated', 'entities', 'seconds']
+    BATCH_FUNCTION = 'migrate_to_dedicated'
+    REPORT_FUNCTION = 'log_migration_report'
+
+    def get(self):
+        from google.appengine.api.labs import taskqueue
+        kind = self.request.get('kind')
+        self.get_target(kind)       # Fail now on kinds that can't migrate
+        taskqueue.add(url=self.request.path, params={'kind': kind})
+
+    def get_target(self, kind):
+        model_class = db.class_for_kind(kind)
+        if not getattr(model_class, 'INDEX_DEDICATED', False):
+            raise search.Error("%s doesn't set INDEX_DEDICATED" % kind)
+        return model_class
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+#
+# The MIT License
+# 
+# Copyright (c) 2009 William T. Katz
+# Website/Contact: http://www.billkatz.com
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to 
+# deal in the Software without restriction, including without limitation 
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER 
+# DEALINGS IN THE SOFTWARE.
+
+
+"""Materialized results for the most frequent search phrases.
+
+A small fraction of search_index_keys() calls are sampled and their counts
+are accumulated in the instance, then flushed in batches to HotQuery
+entities.  A periodic task (see search.handlers.HotQueryRefresh) decays
+the counts, keeps the top HOT_QUERY_TOP_N phrases materialized and
+recomputes the results of any hot query whose kind generation has changed
+since its results were computed.
+
+Once materialized, a hot query is answered with a single get of its
+HotQuery entity, however many phrase filters it would otherwise need.
+Results can be stale for at most one refresh period (10 minutes with the
+shipped cron.yaml) after an entity is indexed.  Unindexing an entity, e.g.
+by its delete(), dematerializes the hot queries listing it, so deleted
+entities drop out at once; entities deleted without unindexing are listed
+until the next refresh.
+"""
+__author__ = 'William T. Katz'
+
+import hashlib
+import logging
+import random
+import time
+
+from google.appengine.ext import db
+
+import search
+
+HOT_QUERY_TOP_N = 200           # Number of phrases kept materialized.
+HOT_QUERY_MAX_CANDIDATES = 500  # Phrases whose counts survive a refresh.
+HOT_QUERY_MAX_RESULTS = 50      # Results stored per hot query.
+HOT_QUERY_SAMPLE_RATE = 0.05    # Fraction of searches that are counted.
+HOT_QUERY_FLUSH_SAMPLES = 20    # Sampled searches held in instance before flush.
+HOT_QUERY_DECAY = 0.5           # Count multiplier applied on each refresh.
+HOT_QUERY_MIN_HITS = 0.5        # Cold candidates decayed below this are dropped.
+HOT_QUERY_SET_TTL = 60          # Seconds an instance trusts its hot set.
+
+# Following module-level state is cached in instance
+
+_samples = {}           # signature -> [count, query params dict]
+_num_samples = 0
+_hot_signatures = None  # frozenset of materialized signatures
+_hot_signatures_expiry = 0
+
+
+class HotQuery(db.Model):
+    """Sampled frequency and, if hot, precomputed results of a search.
+
+    The key name is the query signature returned by get_signature().
+    """
+    phrase = db.StringProperty(required=True)
+    parent_kind = db.StringProperty()
+    stemming = db.BooleanProperty(default=True)
+    multi_word_literal = db.BooleanProperty(default=True)
+    hits = db.FloatProperty(default=0.0)
+    materialized = db.BooleanProperty(default=False)
+    generation = db.IntegerProperty()
+    result_keys = db.ListProperty(db.Key)   # Keys of matching index entities
+    result_parents = db.ListProperty(db.Key)    # Their parent entities
+    refreshed = db.DateTimeProperty(auto_now=True)
+
+    def set_results(self, result_keys):
+        """Stores the index keys of a search and their parent keys."""
+        self.result_keys = result_keys
+        self.result_parents = list(set([key.parent() for key in result_keys]))
+
+    def clear_results(self):
+        """Dematerializes this query until it is recomputed."""
+        self.materialized = False
+        self.generation = None
+        self.set_results([])
+
+    def get_results(self, limit):
+        """Returns up to limit index keys, or None if too few are stored."""
+        num_results = len(self.result_keys)
+        if limit > num_results and num_results >= HOT_QUERY_MAX_RESULTS:
+            return None
+        return self.result_keys[:limit]
+
+
+def normalize_phrase(phrase):
+    """Returns the phrase as full_text_search() splits it into keywords.
+
+    >>> normalize_phrase('  Statue of LIBERTY! ')
+    'statue of liberty'
+    """
+    return ' '.join(search.PUNCTUATION_REGEX.sub(' ', phrase).lower().split())
+
+def get_signature(phrase, kind=None, stemming=True, multi_word_literal=True):
+    """Returns the HotQuery key name for a search and its options."""
+    parts = [normalize_phrase(phrase), kind or '', str(bool(stemming)),
+             str(bool(multi_word_literal))]
+    text = search.KEY_NAME_DELIMITER.join(parts)
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return 'q' + hashlib.md5(text).hexdigest()
+
+def get_hot_signatures(force=False):
+    """Returns the set of materialized query signatures.
+
+    The set is reloaded at most every HOT_QUERY_SET_TTL seconds so cold
+    queries cost no extra RPCs.
+    """
+    global _hot_signatures, _hot_signatures_expiry
+    now = time.time()
+    if force or _hot_signatures is None or now >= _hot_signatures_expiry:
+        query = HotQuery.all(keys_only=True).filter('materialized =', True)
+        _hot_signatures = frozenset([key.name() for key in
+                                     query.fetch(HOT_QUERY_TOP_N)])
+        _hot_signatures_expiry = now + HOT_QUERY_SET_TTL
+    return _hot_signatures
+
+def lookup(phrase, limit=10, kind=None, stemming=True, multi_word_literal=True):
+    """Returns materialized index keys for a hot query, else None.
+
+    The keys can be up to one refresh period old; see the module docstring.
+    """
+    signature = get_signature(phrase, kind, stemming, multi_word_literal)
+    if signature not in get_hot_signatures():
+        return None
+    hot_query = HotQuery.get_by_key_name(signature)
+    if not hot_query or not hot_query.materialized:
+        return None
+    return hot_query.get_results(limit)
+
+def forget_parent(parent_key):
+    """Dematerializes hot queries listing an unindexed entity.
+
+    Takes one query on result_parents, however many index entities the
+    entity had.  The hot queries are answered by live searches until
+    refresh_hot_queries() recomputes them.
+    """
+    query = HotQuery.all().filter('result_parents =', parent_key)
+    hot_queries = query.fetch(HOT_QUERY_TOP_N)
+    for hot_query in hot_queries:
+        hot_query.clear_results()
+    if hot_queries:
+        db.put(hot_queries)
+
+def sample(phrase, kind=None, stemming=True, multi_word_literal=True):
+    """Counts a search with probability HOT_QUERY_SAMPLE_RATE."""
+    global _num_samples
+    if random.random() >= HOT_QUERY_SAMPLE_RATE:
+        return
+    signature = get_signature(phrase, kind, stemming, multi_word_literal)
+    if signature in _samples:
+        _samples[signature][0] += 1
+    else:
+        _samples[signature] = [1, {'phrase': normalize_phrase(phrase),
+                                   'parent_kind': kind,
+                                   'stemming': bool(stemming),
+                                   'multi_word_literal': bool(multi_word_literal)}]
+    _num_samples += 1
+    if _num_samples >= HOT_QUERY_FLUSH_SAMPLES:
+        flush_samples()
+
+def flush_samples():
+    """Adds the instance's sampled counts to HotQuery entities.
+
+    Counts are scaled by 1 / HOT_QUERY_SAMPLE_RATE.  Concurrent flushes
+    from different instances may drop a few samples; counts are estimates.
+    """
+    global _samples, _num_samples
+    if not _samples:
+        return
+    samples, _samples, _num_samples = _samples, {}, 0
+    signatures = samples.keys()
+    hot_queries = HotQuery.get_by_key_name(signatures)
+    scale = 1.0 / HOT_QUERY_SAMPLE_RATE
+    for pos, signature in enumerate(signatures):
+        count, params = samples[signature]
+        if hot_queries[pos] is None:
+            hot_queries[pos] = HotQuery(key_name=signature, **params)
+        hot_queries[pos].hits += count * scale
+    db.put(hot_queries)
+
+def refresh_hot_queries(top_n=HOT_QUERY_TOP_N):
+    """Decays counts, picks the top_n queries and refreshes stale results.
+
+    Returns:
+        A dict with the number of 'hot' queries, how many were 'recomputed'
+        and how many cold candidates were 'dropped'.
+    """
+    flush_samples()
+    query = HotQuery.all().order('-hits')
+    candidates = query.fetch(HOT_QUERY_MAX_CANDIDATES)
+    generations = {}
+    recomputed = 0
+    cold_keys = []
+    for rank, hot_query in enumerate(candidates):
+        hot_query.hits *= HOT_QUERY_DECAY
+        if rank >= top_n:
+            if hot_query.hits < HOT_QUERY_MIN_HITS:
+                cold_keys.append(hot_query.key())
+            hot_query.clear_results()
+            continue
+        kind = hot_query.parent_kind
+        if kind not in generations:
+            generations[kind] = search.get_kind_generation(kind)
+        if hot_query.materialized and hot_query.generation == generations[kind]:
+            continue
+        # Generation is read before searching, so an indexing change that
+        # races with this search will trigger another recomputation.
+        try:
+            hot_query.set_results(search.Searchable.search_index_keys(
+                          hot_query.phrase, limit=HOT_QUERY_MAX_RESULTS,
+                          kind=kind, stemming=hot_query.stemming,
+                          multi_word_literal=hot_query.multi_word_literal,
+                          use_hot_queries=False))
+        except db.KindError:
+            # Only searchable where the model is imported.
+            logging.warning("Not refreshing hot query %r: model of %s not "
+                            "imported", hot_query.phrase, kind)
+            hot_query.clear_results()
+            continue
+        hot_query.generation = generations[kind]
+        hot_query.materialized = True
+        recomputed += 1
+    db.put([hot_query for hot_query in candidates
+            if hot_query.key() not in cold_keys])
+    # Phrases that fell out of the candidate window are forgotten.
+    query = HotQuery.all(keys_only=True).order('-hits')
+    cold_keys.extend(query.fetch(HOT_QUERY_MAX_CANDIDATES,
+                                 offset=HOT_QUERY_MAX_CANDIDATES))
+    db.delete(cold_keys)
+    get_hot_signatures(force=True)
+    logging.info("Refreshed hot queries: %d candidates, %d recomputed, %d dropped",
+                 len(candidates), recomputed, len(cold_keys))
+    return {'hot': min(top_n, len(candidates)), 'recomputed': recomputed,
+            'dropped': len(cold_keys)}
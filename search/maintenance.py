@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+#
+# The MIT License
+# 
+# Copyright (c) 2009 William T. Katz
+# Website/Contact: http://www.billkatz.com
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to 
+# deal in the Software without restriction, including without limitation 
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER 
+# DEALINGS IN THE SOFTWARE.
+
+
+"""Background maintenance of search index entities.
+
+Index entities are scanned in key order a batch at a time.  Each batch
+ends with the last key seen, so a job can be resumed by the next task in
+a chain (see search.handlers.OrphanSweep) without holding any state.
+"""
+__author__ = 'William T. Katz'
+
+import logging
+import time
+
+from google.appengine.api import datastore
+from google.appengine.api import datastore_errors
+from google.appengine.ext import db
+
+import search
+
+SWEEP_BATCH_SIZE = 200          # Index keys examined per batch.
+MIGRATION_BATCH_SIZE = 50       # Parent entities migrated per batch.
+INDEX_CLASSES = [search.StemmedIndex, search.LiteralIndex]   # Shared index models
+
+
+def get_index_classes():
+    """Returns the shared index models and the dedicated ones written to.
+
+    Dedicated index models are found from the records index() leaves, see
+    search.load_dedicated_index_classes().
+    """
+    return INDEX_CLASSES + search.load_dedicated_index_classes()
+
+def get_sweep_classes():
+    """Returns the models whose orphaned entities sweep_orphans() removes.
+
+    These are the index models and IndexHead, which outlives a parent
+    deleted without unindexing just like the index entities do.
+    """
+    return get_index_classes() + [search.IndexHead]
+
+def get_index_class(kind):
+    """Returns the index model class for an index kind name."""
+    for index_class in get_index_classes():
+        if index_class.kind() == kind:
+            return index_class
+    raise search.Error("Unknown index kind '%s'" % kind)
+
+def scan_index_keys(index_class, start_key=None, batch_size=SWEEP_BATCH_SIZE):
+    """Returns the next batch of index keys in key order after start_key."""
+    query = index_class.all(keys_only=True).order('__key__')
+    if start_key:
+        query.filter('__key__ >', start_key)
+    return query.fetch(batch_size)
+
+def get_missing_keys(keys):
+    """Returns the set of keys whose entities don't exist.
+
+    Uses datastore.Get rather than db.get, so the models of the entities
+    needn't be imported.
+    """
+    try:
+        entities = datastore.Get(keys)
+    except datastore_errors.EntityNotFoundError:
+        entities = []
+        for key in keys:
+            try:
+                entities.append(datastore.Get(key))
+            except datastore_errors.EntityNotFoundError:
+                entities.append(None)
+    return set([key for key, entity in zip(keys, entities) if entity is None])
+
+def sweep_orphans(index_class, start_key=None, batch_size=SWEEP_BATCH_SIZE):
+    """Deletes a batch of index entities whose parent entity no longer exists.
+
+    Parents of the batch are checked with one batched get and orphans are
+    removed with one batched delete.
+
+    Args:
+        index_class: One of get_sweep_classes().
+        start_key: db.Key.  Resume the scan after this index key.
+        batch_size: Number of index keys examined.
+
+    Returns:
+        A dict with the number of keys 'scanned', 'orphans' deleted, the
+        'next_key' to resume from (None when the scan is complete) and the
+        'seconds' spent.
+    """
+    start = time.time()
+    index_keys = scan_index_keys(index_class, start_key, batch_size)
+    parent_keys = []
+    for key in index_keys:
+        if key.parent() not in parent_keys:
+            parent_keys.append(key.parent())
+    missing = set()
+    if parent_keys:
+        missing = get_missing_keys(parent_keys)
+    orphan_keys = [key for key in index_keys if key.parent() in missing]
+    if orphan_keys:
+        db.delete(orphan_keys)
+        for kind in set([key.kind() for key in missing]):
+            search.bump_kind_generation(kind)
+    next_key = None
+    if len(index_keys) == batch_size:
+        next_key = index_keys[-1]
+    return {'scanned': len(index_keys), 'orphans': len(orphan_keys),
+            'next_key': next_key, 'seconds': time.time() - start}
+
+def sweep_all_orphans(batch_size=SWEEP_BATCH_SIZE):
+    """Sweeps every index kind in one request and returns the totals.
+
+    Only suitable for small datastores and tests; use the OrphanSweep task
+    chain otherwise.
+    """
+    totals = {'scanned': 0, 'orphans': 0, 'seconds': 0.0}
+    for index_class in get_sweep_classes():
+        next_key = None
+        while True:
+            stats = sweep_orphans(index_class, next_key, batch_size)
+            for name in totals:
+                totals[name] += stats[name]
+            next_key = stats['next_key']
+            if not next_key:
+                break
+    log_sweep_report('all', totals)
+    return totals
+
+def log_sweep_report(kind, totals):
+    """Logs throughput and orphan counts of a finished sweep."""
+    rate = 0.0
+    if totals['seconds']:
+        rate = totals['scanned'] / totals['seconds']
+    logging.info("Orphan sweep of %s: %d index entities scanned, %d orphans "
+                 "deleted, %.1f entities/sec", kind, totals['scanned'],
+                 totals['orphans'], rate)
+
+def get_entity_size(entity):
+    """Returns the encoded size of an entity in bytes."""
+    return len(db.model_to_protobuf(entity).Encode())
+
+def compact_index(index_class, parent_key, multi_entities=True):
+    """Repacks the index entities of one parent into the fewest hash shards.
+
+    Parents with fewer than two index entities, or whose model clears
+    INDEX_USES_MULTI_ENTITIES (multi_entities), are left alone, so a single
+    nearly full shard is never split.  Otherwise phrases duplicated across
+    shards are merged and shards left unchanged by the repartitioning are
+    not rewritten.  Shards not listed by the
+    parent's IndexHead are stale and dropped.  The title and other values
+    of a current index entity are kept, so the parent entity isn't
+    fetched.  Runs in a transaction on the parent's entity group, like
+    Searchable.index().
+
+    Returns:
+        A dict with the number of index 'entities_before' and
+        'entities_after', their 'bytes_before' and 'bytes_after', and the
+        number of index entities 'written' or deleted.
+    """
+    if not multi_entities:
+        return {'entities_before': 0, 'entities_after': 0,
+                'bytes_before': 0, 'bytes_after': 0, 'written': 0}
+    head_key = search.IndexHead.get_key(index_class, parent_key)
+
+    def compact():
+        shards = index_class.all().ancestor(parent_key).fetch(1000)
+        stats = {'entities_before': len(shards), 'entities_after': len(shards),
+                 'bytes_before': 0, 'bytes_after': 0, 'written': 0}
+        if len(shards) < 2:
+            return stats
+        head = db.get(head_key)
+        current = shards
+        if head and head.shards:
+            current = [shard for shard in shards if
+                       int(search.SearchIndex.get_index_num(shard.key().name()))
+                       in head.shards]
+        if not current:
+            current = shards
+        version = max([shard.version for shard in current])
+        phrases = set()
+        for shard in shards:
+            stats['bytes_before'] += get_entity_size(shard)
+        for shard in current:
+            phrases.update(shard.phrases)
+        previous = dict([(shard.key().name(), shard) for shard in shards])
+        current_names = set([shard.key().name() for shard in current])
+        property_names = (current[0].properties().keys() +
+                          current[0].dynamic_properties())
+        template = dict([(name, getattr(current[0], name))
+                         for name in property_names])
+        max_phrases = search.get_max_shard_phrases(
+                        current[0].dynamic_properties(),
+                        dedicated=index_class.PARENT_KIND is not None)
+        base_key_name = current[0].key().name()
+        new_shards = []
+        new_key_names = []
+        new_nums = []
+        changed = []
+        shards_phrases = search.partition_phrases(list(phrases), max_phrases)
+        for shard_num, shard_phrases in enumerate(shards_phrases):
+            if not shard_phrases:
+                continue
+            key_name = search.SearchIndex.set_index_num(base_key_name, shard_num + 1)
+            shard = previous.get(key_name)
+            if (key_name not in current_names or
+                    set(shard.phrases) != set(shard_phrases)):
+                args = dict(template, key_name=key_name, parent=parent_key,
+                            phrases=shard_phrases, version=version)
+                shard = index_class(**args)
+                changed.append(shard)
+            new_shards.append(shard)
+            new_key_names.append(key_name)
+            new_nums.append(shard_num + 1)
+        delete_keys = [shard.key() for key_name, shard in previous.iteritems()
+                       if key_name not in new_key_names]
+        if head and (changed or delete_keys) and head.shards != new_nums:
+            head.shards = new_nums
+            changed.append(head)
+        search.put_and_delete(changed, delete_keys)
+        stats['entities_after'] = len(new_shards)
+        stats['bytes_after'] = sum([get_entity_size(shard) for shard in new_shards])
+        stats['written'] = len([entity for entity in changed
+                                if entity is not head]) + len(delete_keys)
+        return stats
+
+    stats = db.run_in_transaction(compact)
+    if stats['written']:
+        search.bump_kind_generation(parent_key.kind())
+    return stats
+
+def compact_shards(index_class, start_key=None, batch_size=SWEEP_BATCH_SIZE):
+    """Compacts the index entities of the parents found in a batch of keys.
+
+    Parents with a single index entity are left alone, as are those of
+    models that clear INDEX_USES_MULTI_ENTITIES or aren't imported.  A
+    parent whose index entities straddle two batches may be visited twice;
+    the second compaction finds nothing to rewrite.
+
+    Returns:
+        A dict with the number of keys 'scanned', 'parents' compacted,
+        'entities_reclaimed', 'bytes_reclaimed', the 'next_key' to resume
+        from (None when the scan is complete) and the 'seconds' spent.
+    """
+    start = time.time()
+    index_keys = scan_index_keys(index_class, start_key, batch_size)
+    shard_counts = {}
+    parent_keys = []
+    for key in index_keys:
+        if key.parent() not in shard_counts:
+            parent_keys.append(key.parent())
+            shard_counts[key.parent()] = 0
+        shard_counts[key.parent()] += 1
+    result = {'scanned': len(index_keys), 'parents': 0,
+              'entities_reclaimed': 0, 'bytes_reclaimed': 0}
+    for parent_key in parent_keys:
+        # The last parent may have more index entities in the next batch.
+        if shard_counts[parent_key] < 2 and parent_key != parent_keys[-1]:
+            continue
+        try:
+            model_class = db.class_for_kind(parent_key.kind())
+        except db.KindError:
+            logging.warning("Not compacting index of %s: model not imported",
+                            parent_key)
+            continue
+        stats = compact_index(index_class, parent_key,
+                              model_class.INDEX_USES_MULTI_ENTITIES)
+        if stats['entities_before'] < 2:
+            continue
+        result['parents'] += 1
+        result['entities_reclaimed'] += stats['entities_before'] - stats['entities_after']
+        result['bytes_reclaimed'] += stats['bytes_before'] - stats['bytes_after']
+    result['next_key'] = None
+    if len(index_keys) == batch_size:
+        result['next_key'] = index_keys[-1]
+    result['seconds'] = time.time() - start
+    return result
+
+def log_compaction_report(kind, totals):
+    """Logs what a finished compaction job reclaimed."""
+    logging.info("Shard compaction of %s: %d index entities scanned, %d parents "
+                 "compacted, %d entities and %d bytes reclaimed in %.1f s", kind,
+                 totals['scanned'], totals['parents'], totals['entities_reclaimed'],
+                 totals['bytes_reclaimed'], totals['seconds'])
+
+def migrate_index(shared_class, dedicated_class, parent_key):
+    """Moves the index entities of one parent from a shared index model.
+
+    Runs in a transaction on the parent's entity group.  Copies keep their
+    key names, phrases, version and sort or filter values and the version
+    recorded by the IndexHead.  If the parent was already indexed into
+    dedicated_class, the shared index entities are just deleted.
+
+    Returns:
+        The number of shared index entities removed.
+    """
+    def migrate():
+        shards = shared_class.all().ancestor(parent_key).fetch(1000)
+        if not shards:
+            return 0
+        old_head_key = search.IndexHead.get_key(shared_class, parent_key)
+        new_head_key = search.IndexHead.get_key(dedicated_class, parent_key)
+        old_head, new_head = db.get([old_head_key, new_head_key])
+        entities = []
+        if new_head is None:
+            for shard in shards:
+                values = dict([(name, getattr(shard, name))
+                               for name in shard.properties().keys() +
+                                           shard.dynamic_properties()
+                               if name != 'parent_kind'])
+                entities.append(dedicated_class(key_name=shard.key().name(),
+                                                parent=parent_key, **values))
+            versions = [shard.version for shard in shards
+                        if shard.version is not None]
+            if old_head:
+                versions.append(old_head.version)
+            if versions:
+                entities.append(search.IndexHead(key_name=dedicated_class.kind(),
+                                                 parent=parent_key,
+                                                 version=max(versions),
+                                                 shards=old_head and old_head.shards or []))
+        search.put_and_delete(entities,
+                              [shard.key() for shard in shards] + [old_head_key])
+        return len(shards)
+
+    return db.run_in_transaction(migrate)
+
+def migrate_to_dedicated(model_class, start_key=None,
+                         batch_size=MIGRATION_BATCH_SIZE):
+    """Moves a batch of a kind's index entities to its dedicated index model.
+
+    Set INDEX_DEDICATED on the model and deploy first; from then on
+    index() writes the dedicated model.  Searches read both the dedicated
+    and the shared model until the last batch marks the migration complete
+    (see search.mark_migration_complete()), so a kind that newly sets
+    INDEX_DEDICATED should be migrated even if it has no index entities
+    yet.  Batches go through the kind's entities in key order and can be
+    chained like sweep_orphans() (see search.handlers.IndexMigration).
+
+    Returns:
+        A dict with the number of entities 'scanned' and 'migrated', the
+        index 'entities' moved, the 'next_key' to resume from (None when
+        the kind is done) and the 'seconds' spent.
+    """
+    if not model_class.INDEX_DEDICATED:
+        raise search.Error("%s doesn't set INDEX_DEDICATED" % model_class.kind())
+    start = time.time()
+    shared_class = model_class.INDEX_STEMMING and search.StemmedIndex or \
+                   search.LiteralIndex
+    dedicated_class = model_class.get_index_class()
+    search.record_dedicated_index_class(dedicated_class)
+    query = model_class.all(keys_only=True).order('__key__')
+    if start_key:
+        query.filter('__key__ >', start_key)
+    parent_keys = query.fetch(batch_size)
+    result = {'scanned': len(parent_keys), 'migrated': 0, 'entities': 0}
+    for parent_key in parent_keys:
+        moved = migrate_index(shared_class, dedicated_class, parent_key)
+        if moved:
+            result['migrated'] += 1
+            result['entities'] += moved
+    if result['migrated']:
+        search.bump_kind_generation(model_class.kind())
+    result['next_key'] = None
+    if len(parent_keys) == batch_size:
+        result['next_key'] = parent_keys[-1]
+    else:
+        search.mark_migration_complete(model_class.kind())
+    result['seconds'] = time.time() - start
+    return result
+
+def log_migration_report(kind, totals):
+    """Logs what a finished migration to a dedicated index model moved."""
+    logging.info("Index migration of %s: %d entities scanned, %d migrated, "
+                 "%d index entities moved in %.1f s", kind, totals['scanned'],
+                 totals['migrated'], totals['entities'], totals['seconds'])
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+#
+# The MIT License
+# 
+# Copyright (c) 2009 William T. Katz
+# Website/Contact: http://www.billkatz.com
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to 
+# deal in the Software without restriction, including without limitation 
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER 
+# DEALINGS IN THE SOFTWARE.
+
+
+"""Instance-local postings of hot search terms.
+
+A postings list holds the index entities of one kind that contain a term,
+as a sorted array of parent ids (or a tuple of key names) with the index
+key name of each.  Multi-term searches intersect the cached lists in
+memory, matching entries on both the parent and the index key name so
+that, like the datastore's merge-join, all terms must be in the same
+index entity.  Only terms that aren't cached are queried.  Terms are
+cached once they have been searched HOT_TERM_QUERIES times, least
+recently used lists are evicted to stay under POSTINGS_MEMORY_BUDGET, and
+lists are dropped when the generation of their kind changes (see
+search.bump_kind_generation()).  Generations are read from memcache at
+most every GENERATION_CHECK_TTL seconds and only by searches with a term
+that is cached or about to be, so other instances' index changes show up
+after that delay.
+
+Only complete postings are cached, so terms in more than MAX_POSTINGS
+index entities, and kinds whose entities have parents of their own, are
+always searched in the datastore.
+"""
+__author__ = 'William T. Katz'
+
+import array
+import bisect
+import time
+
+from google.appengine.ext import db
+
+import search
+
+POSTINGS_MEMORY_BUDGET = 4 * 1024 * 1024    # Approximate bytes per instance.
+MAX_POSTINGS = 999          # Longest cached list; fetch() returns at most 1000.
+HOT_TERM_QUERIES = 3        # Searches of a term before its postings are cached.
+MAX_TRACKED_TERMS = 10000   # Search counts kept for terms not yet cached.
+STRING_OVERHEAD = 40        # Approximate bytes per cached string.
+GENERATION_CHECK_TTL = 2    # Seconds a kind generation read from memcache is used.
+
+_cache = {}         # (index kind, parent kind, term) -> Postings
+_cache_size = 0
+_clock = 0
+_term_counts = {}   # (index kind, parent kind, term) -> searches
+_generations = {}   # parent kind -> (generation, time read)
+
+
+class Postings(object):
+    """Sorted parent ids of one term and kind, with an index key name each.
+
+    A parent with several index entities containing the term has an entry
+    for each.
+
+    Ids is None for terms that can't be cached, so they aren't reloaded
+    until the kind's generation changes.
+    """
+    __slots__ = ['ids', 'names', 'generation', 'size', 'last_used']
+
+    def __init__(self, ids, names, generation):
+        self.ids = ids
+        self.names = names
+        self.generation = generation
+        self.size = STRING_OVERHEAD
+        for name in names:
+            self.size += len(name) + STRING_OVERHEAD
+        if isinstance(ids, array.array):
+            self.size += ids.itemsize * len(ids)
+        elif ids:
+            for id_or_name in ids:
+                if isinstance(id_or_name, basestring):
+                    self.size += len(id_or_name) + STRING_OVERHEAD
+                else:
+                    self.size += STRING_OVERHEAD
+
+def make_postings(index_keys, generation):
+    """Returns Postings for index keys, with ids None if they can't be cached."""
+    entries = set()
+    for key in index_keys:
+        parent_key = key.parent()
+        if parent_key.parent() is not None:
+            return Postings(None, (), generation)
+        entries.add((parent_key.id_or_name(), key.name()))
+    entries = sorted(entries)
+    ids = [id_or_name for id_or_name, name in entries]
+    names = tuple([name for id_or_name, name in entries])
+    try:
+        ids = array.array('l', ids)
+    except (TypeError, OverflowError):
+        # Key names, or ids too big for a C long
+        ids = tuple(ids)
+    return Postings(ids, names, generation)
+
+def _find(postings, id_or_name, name, start):
+    """Returns the position of an entry at or after start, or -1."""
+    pos = bisect.bisect_left(postings.ids, id_or_name, start)
+    while pos < len(postings.ids) and postings.ids[pos] == id_or_name:
+        if postings.names[pos] == name:
+            return pos
+        pos += 1
+    return -1
+
+def intersect(postings_list):
+    """Returns (id, index key name) pairs of the entries in all postings."""
+    postings_list = sorted(postings_list, key=lambda postings: len(postings.ids))
+    shortest = postings_list[0]
+    others = postings_list[1:]
+    starts = [0] * len(others)
+    matches = []
+    for pos, id_or_name in enumerate(shortest.ids):
+        name = shortest.names[pos]
+        for num, postings in enumerate(others):
+            starts[num] = bisect.bisect_left(postings.ids, id_or_name, starts[num])
+            if _find(postings, id_or_name, name, starts[num]) < 0:
+                break
+        else:
+            matches.append((id_or_name, name))
+    return matches
+
+def _remove(cache_key):
+    global _cache_size
+    _cache_size -= _cache.pop(cache_key).size
+
+def _add(cache_key, postings):
+    global _cache_size
+    if postings.size > POSTINGS_MEMORY_BUDGET:
+        return
+    while _cache and _cache_size + postings.size > POSTINGS_MEMORY_BUDGET:
+        lru_key = min(_cache.keys(), key=lambda x: _cache[x].last_used)
+        _remove(lru_key)
+    _cache[cache_key] = postings
+    _cache_size += postings.size
+
+def get_postings(index_class, kind, term, generation):
+    """Returns the cached Postings of a term, or None if it isn't cached.
+
+    The postings of a term are loaded on its HOT_TERM_QUERIES-th search.
+    """
+    global _clock
+    cache_key = (index_class.kind(), kind, term)
+    postings = _cache.get(cache_key)
+    if postings is not None and postings.generation != generation:
+        _remove(cache_key)
+        postings = None
+    if postings is None:
+        count = _term_counts.get(cache_key, 0) + 1
+        if count < HOT_TERM_QUERIES:
+            if len(_term_counts) >= MAX_TRACKED_TERMS:
+                _term_counts.clear()
+            _term_counts[cache_key] = count
+            return None
+        _term_counts.pop(cache_key, None)
+        query = search.Searchable.get_index_query([term], kind,
+                                                  index_class=index_class)
+        index_keys = query.fetch(MAX_POSTINGS + 1)
+        if len(index_keys) > MAX_POSTINGS:
+            postings = Postings(None, (), generation)
+        else:
+            postings = make_postings(index_keys, generation)
+        _add(cache_key, postings)
+    _clock += 1
+    postings.last_used = _clock
+    if postings.ids is None:
+        return None
+    return postings
+
+def get_generation(kind):
+    """Returns the generation of a kind, read at most every GENERATION_CHECK_TTL."""
+    now = time.time()
+    checked = _generations.get(kind)
+    if checked is None or now - checked[1] > GENERATION_CHECK_TTL:
+        checked = (search.get_kind_generation(kind), now)
+        _generations[kind] = checked
+    return checked[0]
+
+def forget_generation(kind):
+    """Makes the next search of a kind read its generation again.
+
+    Called by search.bump_kind_generation(), so an instance sees its own
+    index changes at once.
+    """
+    _generations.pop(kind, None)
+
+def get_index_keys(index_class, kind, terms, limit):
+    """Returns keys of index entities of kind with all terms, using postings.
+
+    Terms without cached postings are matched by one datastore query,
+    whose results are intersected with the cached postings.  Searches with
+    no cached or newly hot term don't read the kind's generation.
+
+    Returns:
+        A list of up to limit index keys in key order, or None if no term
+        is cached or the uncached terms match too many entities.  The
+        caller should then query the datastore for all terms.
+    """
+    generation = None
+    for term in terms:
+        cache_key = (index_class.kind(), kind, term)
+        if (cache_key in _cache or
+                _term_counts.get(cache_key, 0) + 1 >= HOT_TERM_QUERIES):
+            generation = get_generation(kind)
+            break
+    cached = []
+    missing = []
+    for term in terms:
+        postings = get_postings(index_class, kind, term, generation)
+        if postings is None:
+            missing.append(term)
+        else:
+            cached.append(postings)
+    if not cached:
+        return None
+    if missing:
+        query = search.Searchable.get_index_query(missing, kind,
+                                                  index_class=index_class)
+        index_keys = query.fetch(MAX_POSTINGS + 1)
+        if len(index_keys) > MAX_POSTINGS:
+            return None
+        postings = make_postings(index_keys, generation)
+        if postings.ids is None:
+            return None
+        cached.append(postings)
+    return [db.Key.from_path(kind, id_or_name, index_class.kind(), name)
+            for id_or_name, name in intersect(cached)[:limit]]
+
+def clear():
+    """Empties the cache of this instance."""
+    global _cache_size
+    _cache.clear()
+    _term_counts.clear()
+    _generations.clear()
+    _cache_size = 0
+
+def get_cache_size():
+    """Returns the number of cached postings and their approximate bytes."""
+    return len(_cache), _cache_size
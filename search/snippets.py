@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+#
+# The MIT License
+# 
+# Copyright (c) 2009 William T. Katz
+# Website/Contact: http://www.billkatz.com
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to 
+# deal in the Software without restriction, including without limitation 
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER 
+# DEALINGS IN THE SOFTWARE.
+
+
+"""Highlighted snippets of the text that matched a search phrase.
+
+A PhraseMatcher is built once per query and can be shared by all the
+result entities.  It folds the phrase's keywords (and their stems) plus
+the literal multi-word phrase into one precompiled alternation, so each
+text is scanned once by the regex engine.  In CPython this is much faster
+than running an Aho-Corasick automaton one character at a time in Python.
+
+Windows are scored by the number of distinct query terms they contain,
+then by number of matches, and scanning stops early once enough
+non-overlapping windows holding every term have been found.
+"""
+__author__ = 'William T. Katz'
+
+import cgi
+import re
+
+import search
+
+DEFAULT_MAX_SNIPPETS = 3
+DEFAULT_SNIPPET_LENGTH = 200    # Characters per snippet, before ellipses.
+SNIPPET_LEAD_FRACTION = 5       # 1/5th of a snippet is context before a match.
+
+WHITESPACE_REGEX = re.compile(r'\s+', re.UNICODE)
+
+
+class PhraseMatcher(object):
+    """Precompiled multi-pattern matcher for the terms of a search phrase.
+
+    >>> matcher = PhraseMatcher('Statue of Liberty', stemming=False)
+    >>> matcher.get_snippets(['I saw the Statue of Liberty.'])
+    ['I saw the <b>Statue of Liberty</b>.']
+    """
+    def __init__(self, phrase, stemming=True, analyzer=search.DEFAULT_ANALYZER):
+        keywords = search.PUNCTUATION_REGEX.sub(' ', phrase).lower().split()
+        terms = analyzer.get_keywords(phrase)
+        self.patterns = {}      # Lowercase pattern -> set of term numbers
+        for term_num, term in enumerate(terms):
+            self.patterns[term] = frozenset([term_num])
+            if stemming:
+                stem = search.get_stemmer().stemWord(term)
+                if len(stem) >= analyzer.min_length:
+                    self.patterns.setdefault(stem, frozenset([term_num]))
+        self.num_terms = len(terms)
+        if len(keywords) > 1 and terms:
+            # The literal phrase counts for all of its terms plus a bonus term.
+            self.patterns[' '.join(keywords)] = frozenset(range(len(terms) + 1))
+            self.num_terms += 1
+        if self.patterns:
+            alternatives = sorted(self.patterns.keys(), key=len, reverse=True)
+            alternatives = [r'\s+'.join([re.escape(word) for word in alt.split()])
+                            for alt in alternatives]
+            self.regex = re.compile(r'\b(%s)\w*' % '|'.join(alternatives),
+                                    re.IGNORECASE | re.UNICODE)
+        else:
+            self.regex = None
+
+    def iter_matches(self, text):
+        """Yields (start, end, term numbers) for each match in text."""
+        if not self.regex or not text:
+            return
+        for match in self.regex.finditer(text):
+            pattern = ' '.join(match.group(1).lower().split())
+            yield match.start(), match.end(), self.patterns[pattern]
+
+    def get_windows(self, text, max_windows=DEFAULT_MAX_SNIPPETS,
+                    length=DEFAULT_SNIPPET_LENGTH):
+        """Returns scored candidate windows around matches in text.
+
+        Each window is a (score, start, matches) tuple where score is a
+        (distinct terms, number of matches) tuple and matches holds the
+        (start, end) spans of the matches that fit in the window.
+        """
+        span = length - length / SNIPPET_LEAD_FRACTION
+        windows = []
+        pending = []
+        perfect_windows = 0
+        perfect_end = -1
+
+        def close_window():
+            anchor = pending[0][0]
+            matches = []
+            terms = set()
+            for start, end, term_nums in pending:
+                if end > anchor + span:
+                    break
+                matches.append((start, end))
+                terms.update(term_nums)
+            windows.append(((len(terms), len(matches)), anchor, matches))
+            del pending[0]
+            return len(terms) == self.num_terms
+
+        for match in self.iter_matches(text):
+            while pending and match[1] > pending[0][0] + span:
+                anchor = pending[0][0]
+                if close_window() and anchor >= perfect_end:
+                    perfect_windows += 1
+                    perfect_end = anchor + span
+            if perfect_windows >= max_windows:
+                break
+            pending.append(match)
+        while pending:
+            close_window()
+        return windows
+
+    def get_snippets(self, texts, max_snippets=DEFAULT_MAX_SNIPPETS,
+                     length=DEFAULT_SNIPPET_LENGTH, highlight=('<b>', '</b>'),
+                     escape=cgi.escape):
+        """Returns up to max_snippets highlighted snippets from texts.
+
+        Args:
+            texts: List of strings, e.g., the values of several properties.
+            highlight: Tuple of strings placed before and after each match.
+            escape: Function applied to the text outside the highlight markup.
+
+        Returns:
+            A list of strings in text order.  If nothing matches, the start
+            of the first non-empty text is returned as the only snippet.
+        """
+        candidates = []
+        for text_num, text in enumerate(texts):
+            for score, anchor, matches in self.get_windows(text, max_snippets, length):
+                candidates.append((score, text_num, anchor, matches))
+        # Best windows first; ties go to the earlier window.
+        candidates.sort(key=lambda c: (-c[0][0], -c[0][1], c[1], c[2]))
+        span = length - length / SNIPPET_LEAD_FRACTION
+        chosen = []
+        for candidate in candidates:
+            score, text_num, anchor, matches = candidate
+            overlaps = [c for c in chosen if c[1] == text_num and
+                        anchor < c[2] + span and c[2] < anchor + span]
+            if not overlaps:
+                chosen.append(candidate)
+                if len(chosen) == max_snippets:
+                    break
+        chosen.sort(key=lambda c: (c[1], c[2]))
+        snippets = [render_snippet(texts[text_num], anchor - (length - span),
+                                   length, matches, highlight, escape)
+                    for score, text_num, anchor, matches in chosen]
+        if not snippets:
+            for text in texts:
+                if text:
+                    snippets.append(render_snippet(text, 0, length, [],
+                                                   highlight, escape))
+                    break
+        return snippets
+
+
+def render_snippet(text, start, length, matches, highlight=('<b>', '</b>'),
+                   escape=cgi.escape):
+    """Returns text[start:start + length] with highlighted matches.
+
+    The window is trimmed to whole words and marked with ellipses where
+    it cuts the text.
+
+    >>> render_snippet('one two three four', 5, 9, [(8, 13)])
+    '...<b>three</b>...'
+    """
+    start = max(0, start)
+    end = min(len(text), start + length)
+    if start > 0 and not text[start - 1].isspace():
+        next_space = WHITESPACE_REGEX.search(text, start, end)
+        if next_space and (not matches or next_space.end() <= matches[0][0]):
+            start = next_space.end()
+    if end < len(text) and not text[end].isspace():
+        cut = end
+        while cut > start and not text[cut - 1].isspace():
+            cut -= 1
+        if cut > start and (not matches or cut > matches[-1][1]):
+            end = cut
+    pieces = []
+    pos = start
+    for match_start, match_end in matches:
+        pieces.append(escape(text[pos:match_start]))
+        pieces.append(highlight[0] + escape(text[match_start:match_end]) + highlight[1])
+        pos = match_end
+    pieces.append(escape(text[pos:end]))
+    snippet = WHITESPACE_REGEX.sub(' ', ''.join(pieces)).strip()
+    if start > 0:
+        snippet = '...' + snippet
+    if end < len(text):
+        snippet += '...'
+    return snippet
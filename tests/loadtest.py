@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+#
+# The MIT License
+# 
+# Copyright (c) 2009 William T. Katz
+# Website/Contact: http://www.billkatz.com
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to 
+# deal in the Software without restriction, including without limitation 
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER 
+# DEALINGS IN THE SOFTWARE.
+
+
+"""Workload replay and load generation for the demo WSGI app.
+
+Drives main.application in process through WebTest against the local
+datastore, memcache, task queue and user service stubs.  A workload is a
+JSONL file with one operation per line:
+
+    {"op": "post_page", "title": "...", "content": "..."}
+    {"op": "run_tasks"}
+    {"op": "search", "phrase": "...", "mode": "keys"}   # or "full"
+
+post_page submits a page through '/', run_tasks executes the indexing
+tasks queued so far and search requests '/search'.  If no workload file
+is given, a synthetic one is generated from the words of tests/roget.txt.
+
+Usage (with the App Engine SDK on PYTHONPATH):
+
+    python tests/loadtest.py --pages 200 --searches 1000 --concurrency 4
+    python tests/loadtest.py --write-workload /tmp/workload.jsonl
+    python tests/loadtest.py --workload /tmp/workload.jsonl
+
+The report lists requests/sec, p50/p95/p99 latency and datastore RPCs
+per request for each operation.
+"""
+
+import base64
+import cgi
+import optparse
+import os
+import random
+import sys
+import threading
+import time
+import Queue
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
+
+ROGET_PATH = os.path.join(APP_DIR, 'tests', 'roget.txt')
+SEARCH_URLS = {'keys': 'Return Keys Only', 'full': 'Return Pages'}
+
+
+class CountingStub(object):
+    """Wraps an API stub and counts its calls per thread.
+
+    SDKs whose stubs have CreateRPC() send calls, including asynchronous
+    ones, through the RPC objects it returns.  Those RPCs are bound to the
+    wrapper, so their calls reach MakeSyncCall() here too.
+    """
+    def __init__(self, stub):
+        self.stub = stub
+        self.local = threading.local()
+
+    def __getattr__(self, name):
+        attr = getattr(self.stub, name)
+        if name == 'CreateRPC':
+            from google.appengine.api import apiproxy_rpc
+            return lambda: apiproxy_rpc.RPC(stub=self)
+        return attr
+
+    def MakeSyncCall(self, service, call, request, response):
+        self.local.calls = getattr(self.local, 'calls', 0) + 1
+        return self.stub.MakeSyncCall(service, call, request, response)
+
+    def reset(self):
+        self.local.calls = 0
+
+    def count(self):
+        return getattr(self.local, 'calls', 0)
+
+
+def setup_stubs(user_email='loadtest@example.org'):
+    """Registers fresh local stubs and returns the counting datastore stub."""
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.api import datastore_file_stub
+    from google.appengine.api import user_service_stub
+    from google.appengine.api.labs.taskqueue import taskqueue_stub
+    from google.appengine.api.memcache import memcache_stub
+
+    os.environ['APPLICATION_ID'] = 'billkatz-test'
+    os.environ['AUTH_DOMAIN'] = 'example.org'
+    os.environ['USER_EMAIL'] = user_email
+    os.environ.setdefault('SERVER_NAME', 'localhost')
+    os.environ.setdefault('SERVER_PORT', '80')
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    datastore = CountingStub(datastore_file_stub.DatastoreFileStub(
+                    'billkatz-test', '/dev/null', '/dev/null'))
+    apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', datastore)
+    apiproxy_stub_map.apiproxy.RegisterStub('memcache',
+                                            memcache_stub.MemcacheServiceStub())
+    apiproxy_stub_map.apiproxy.RegisterStub('user',
+                                            user_service_stub.UserServiceStub())
+    apiproxy_stub_map.apiproxy.RegisterStub('taskqueue',
+                                            taskqueue_stub.TaskQueueServiceStub(root_path=APP_DIR))
+    return datastore
+
+
+def load_words(path=ROGET_PATH):
+    """Returns the distinct words of a text file."""
+    words = {}
+    for word in open(path).read().decode('utf-8').split():
+        words[word] = True
+    return sorted(words.keys())
+
+def generate_workload(num_pages=100, words_per_page=200, num_searches=500,
+                      full_ratio=0.25, task_every=10, seed=1, words=None):
+    """Returns a list of workload operations over a synthetic corpus.
+
+    Pages are random draws from the roget.txt vocabulary, so any search
+    phrase drawn from that vocabulary has a chance of matching.  Searches
+    are interleaved with the page posts once the first pages are indexed.
+
+    Args:
+        num_pages: Number of pages posted.
+        words_per_page: Number of words in each page.
+        num_searches: Number of search requests.
+        full_ratio: Fraction of searches that return whole pages.
+        task_every: Queued indexing tasks are run after this many posts.
+        seed: Seed of the random generator, for repeatable workloads.
+    """
+    rand = random.Random(seed)
+    words = words or load_words()
+    operations = []
+    for page_num in xrange(num_pages):
+        content = ' '.join([rand.choice(words) for i in xrange(words_per_page)])
+        operations.append({'op': 'post_page', 'title': 'Page %d' % page_num,
+                           'content': content})
+        if (page_num + 1) % task_every == 0 or page_num == num_pages - 1:
+            operations.append({'op': 'run_tasks'})
+    searches = []
+    for search_num in xrange(num_searches):
+        phrase = ' '.join([rand.choice(words) for i in xrange(rand.randint(1, 3))])
+        mode = rand.random() < full_ratio and 'full' or 'keys'
+        searches.append({'op': 'search', 'phrase': phrase, 'mode': mode})
+    # Searches start after the first batch of pages has been indexed.
+    first_tasks = [pos for pos, op in enumerate(operations)
+                   if op['op'] == 'run_tasks'][0]
+    for op in searches:
+        pos = rand.randint(first_tasks + 1, len(operations))
+        operations.insert(pos, op)
+    return operations
+
+def read_workload(path):
+    """Returns the operations of a JSONL workload file."""
+    operations = []
+    for line in open(path):
+        line = line.strip()
+        if line:
+            operations.append(json.loads(line))
+    return operations
+
+def write_workload(operations, path):
+    out = open(path, 'w')
+    for op in operations:
+        out.write(json.dumps(op) + '\n')
+    out.close()
+
+
+class WorkloadRunner(object):
+    """Replays workload operations against main.application."""
+    def __init__(self, datastore):
+        from webtest import TestApp
+        import main
+        self.app = TestApp(main.application)
+        self.datastore = datastore
+        self.task_lock = threading.Lock()
+        self.samples = {}       # op name -> list of (seconds, datastore RPCs)
+        self.samples_lock = threading.Lock()
+
+    def run_tasks(self):
+        """Executes queued tasks through the app.  Returns the number run."""
+        from google.appengine.api import apiproxy_stub_map
+        taskqueue = apiproxy_stub_map.apiproxy.GetStub('taskqueue')
+        self.task_lock.acquire()
+        try:
+            tasks = taskqueue.GetTasks('default')
+            taskqueue.FlushQueue('default')
+        finally:
+            self.task_lock.release()
+        for task in tasks:
+            params = dict(cgi.parse_qsl(base64.b64decode(task['body'])))
+            self.app.post(task['url'], params)
+        return len(tasks)
+
+    def execute(self, op):
+        """Runs one operation and records its latency and datastore RPCs."""
+        self.datastore.reset()
+        start = time.time()
+        if op['op'] == 'post_page':
+            self.app.post('/', {'title': op['title'], 'content': op['content']})
+        elif op['op'] == 'run_tasks':
+            self.run_tasks()
+        elif op['op'] == 'search':
+            self.app.get('/search', {'phrase': op['phrase'],
+                                     'submitbtn': SEARCH_URLS[op.get('mode', 'keys')]})
+        else:
+            raise ValueError("Unknown workload operation '%s'" % op['op'])
+        elapsed = time.time() - start
+        name = op['op']
+        if name == 'search':
+            name = 'search_' + op.get('mode', 'keys')
+        self.samples_lock.acquire()
+        try:
+            self.samples.setdefault(name, []).append((elapsed, self.datastore.count()))
+        finally:
+            self.samples_lock.release()
+
+    def replay(self, operations, concurrency=1):
+        """Replays operations with the given number of threads.
+
+        Returns:
+            Wall clock seconds for the whole replay.
+        """
+        start = time.time()
+        if concurrency <= 1:
+            for op in operations:
+                self.execute(op)
+        else:
+            pending = Queue.Queue()
+            for op in operations:
+                pending.put(op)
+            errors = []
+            def worker():
+                while True:
+                    try:
+                        op = pending.get_nowait()
+                    except Queue.Empty:
+                        return
+                    try:
+                        self.execute(op)
+                    except Exception, e:
+                        errors.append(e)
+            threads = [threading.Thread(target=worker) for i in xrange(concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if errors:
+                raise errors[0]
+        return time.time() - start
+
+
+def percentile(values, fraction):
+    """Returns the nearest-rank percentile of a list of numbers.
+
+    >>> percentile([4, 1, 3, 2], 0.5)
+    2
+    """
+    values = sorted(values)
+    if not values:
+        return 0
+    rank = max(int(fraction * len(values) + 0.999999) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+def summarize(samples, wall_seconds):
+    """Returns a report row dict per operation name."""
+    rows = []
+    for name in sorted(samples):
+        latencies = [seconds * 1000.0 for seconds, rpcs in samples[name]]
+        rpcs = [rpcs for seconds, rpcs in samples[name]]
+        rows.append({'op': name, 'count': len(latencies),
+                     'rps': wall_seconds and len(latencies) / wall_seconds or 0.0,
+                     'p50': percentile(latencies, 0.50),
+                     'p95': percentile(latencies, 0.95),
+                     'p99': percentile(latencies, 0.99),
+                     'rpcs': float(sum(rpcs)) / len(rpcs)})
+    return rows
+
+def format_report(rows, wall_seconds):
+    lines = ['%-14s %7s %9s %9s %9s %9s %9s' %
+             ('operation', 'count', 'req/sec', 'p50 ms', 'p95 ms', 'p99 ms', 'RPCs/req')]
+    for row in rows:
+        lines.append('%(op)-14s %(count)7d %(rps)9.1f %(p50)9.1f %(p95)9.1f '
+                     '%(p99)9.1f %(rpcs)9.1f' % row)
+    total = sum([row['count'] for row in rows])
+    lines.append('%d operations in %.2f s' % (total, wall_seconds))
+    return '\n'.join(lines)
+
+def run(operations, concurrency=1):
+    """Replays operations on fresh stubs and returns (rows, wall seconds)."""
+    datastore = setup_stubs()
+    runner = WorkloadRunner(datastore)
+    wall_seconds = runner.replay(operations, concurrency)
+    return summarize(runner.samples, wall_seconds), wall_seconds
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--workload', help='JSONL workload file to replay')
+    parser.add_option('--write-workload', dest='write_workload',
+                      help='write the generated workload here and exit')
+    parser.add_option('--pages', type='int', default=100)
+    parser.add_option('--words-per-page', dest='words_per_page', type='int', default=200)
+    parser.add_option('--searches', type='int', default=500)
+    parser.add_option('--full-ratio', dest='full_ratio', type='float', default=0.25,
+                      help='fraction of searches returning whole pages')
+    parser.add_option('--concurrency', type='int', default=1)
+    parser.add_option('--seed', type='int', default=1)
+    options, args = parser.parse_args(argv)
+    if options.workload:
+        operations = read_workload(options.workload)
+    else:
+        operations = generate_workload(options.pages, options.words_per_page,
+                                       options.searches, options.full_ratio,
+                                       seed=options.seed)
+    if options.write_workload:
+        write_workload(operations, options.write_workload)
+        return
+    rows, wall_seconds = run(operations, options.concurrency)
+    print format_report(rows, wall_seconds)
+
+if __name__ == '__main__':
+    main()
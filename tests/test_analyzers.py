@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+#
+# The MIT License
+# 
+# Copyright (c) 2009 William T. Katz
+# Website/Contact: http://www.billkatz.com
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to 
+# deal in the Software without restriction, including without limitation 
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER 
+# DEALINGS IN THE SOFTWARE.
+
+
+
+from google.appengine.ext import db
+import search
+from search import analyzers
+
+from tests.test_search import clear_datastore
+
+class ProfiledPage(search.Searchable, db.Model):
+    content = db.TextProperty()
+    INDEX_ANALYZER = search.AnalyzerProfile(min_length=3, max_words=2,
+                                            name='profiled')
+
+def add_pages(num_pages):
+    for i in xrange(num_pages):
+        page = ProfiledPage(key_name='page%d' % i,
+                            content='Widget catalog entry %d about the %s tool.'
+                                    % (i, ['red', 'blue'][i % 2]))
+        page.put()
+        page.index()
+
+class TestAnalyzerProfile:
+    def setup(self):
+        clear_datastore()
+        ProfiledPage.INDEX_ANALYZER.reset()
+
+    def test_phraseset(self):
+        phrases = ProfiledPage.get_search_phraseset('I saw the red Statue of Liberty.')
+        assert 'saw' in phrases and 'red' in phrases
+        assert 'red statue' in phrases
+        assert 'saw the statue' not in phrases
+        assert 'statue of liberty' not in phrases
+
+    def test_default_unchanged(self):
+        assert search.Searchable.get_analyzer() is search.DEFAULT_ANALYZER
+        phrases = search.Searchable.get_search_phraseset('I saw the Statue of Liberty.')
+        assert phrases == set(['saw the statue', 'statue of liberty', 'liberty', 'statue'])
+
+    def test_search_uses_profile(self):
+        add_pages(2)
+        assert len(ProfiledPage.search('red tool')) == 1
+        # Stop words in a search phrase are ignored, not required
+        assert len(ProfiledPage.search('about tool')) == 2
+        assert ProfiledPage.search('about the') == []
+
+class TestDerivedStopWords:
+    def setup(self):
+        clear_datastore()
+        ProfiledPage.INDEX_ANALYZER.reset()
+
+    def test_too_few_entities(self):
+        add_pages(analyzers.MIN_SAMPLE_SIZE - 1)
+        assert analyzers.derive_stop_words(ProfiledPage) == set()
+
+    def test_derive(self):
+        add_pages(analyzers.MIN_SAMPLE_SIZE)
+        words = analyzers.derive_stop_words(ProfiledPage)
+        assert words == set(['widget', 'catalog', 'entry', 'tool'])
+        assert 'widget' in ProfiledPage.get_analyzer().get_stop_words()
+        assert 'widget' not in ProfiledPage.get_search_phraseset('Widget red')
+        assert 'red' in ProfiledPage.get_search_phraseset('Widget red')
+
+    def test_other_instance_sees_new_version(self):
+        add_pages(analyzers.MIN_SAMPLE_SIZE)
+        # A profile of the same name elsewhere, already holding stop words.
+        other = search.AnalyzerProfile(name='profiled')
+        assert 'widget' not in other.get_stop_words()
+        analyzers.derive_stop_words(ProfiledPage)
+        assert 'widget' not in other.get_stop_words()
+        other._checked -= search.DERIVED_STOP_WORDS_TTL + 1
+        assert 'widget' in other.get_stop_words()
+
+    def test_report(self):
+        add_pages(analyzers.MIN_SAMPLE_SIZE)
+        analyzers.derive_stop_words(ProfiledPage)
+        report = analyzers.get_profile_report(ProfiledPage)
+        assert report['sampled'] == analyzers.MIN_SAMPLE_SIZE
+        assert report['phrases_after'] < report['phrases_before']
+        assert report['bytes_after'] < report['bytes_before']
+        analyzers.log_profile_report(ProfiledPage.kind(), report)
+
+    def test_unnamed_profile(self):
+        try:
+            analyzers.derive_stop_words(search.Searchable)
+        except search.Error:
+            pass
+        else:
+            assert False, 'search.Error not raised'
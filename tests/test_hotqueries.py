@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#
+# The MIT License
+# 
+# Copyright (c) 2009 William T. Katz
+# Website/Contact: http://www.billkatz.com
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to 
+# deal in the Software without restriction, including without limitation 
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER 
+# DEALINGS IN THE SOFTWARE.
+
+
+from google.appengine.ext import db
+import search
+from search import hotqueries
+
+from tests.test_search import clear_datastore
+
+class HotPage(search.Searchable, db.Model):
+    title = db.StringProperty()
+    content = db.TextProperty()
+    INDEX_TITLE_FROM_PROP = 'title'
+
+def add_page(key_name, title, content):
+    page = HotPage(key_name=key_name, title=title, content=content)
+    page.put()
+    page.index()
+    return page
+
+class TestHotQueries:
+    def setup(self):
+        clear_datastore()
+        hotqueries._samples.clear()
+        hotqueries._num_samples = 0
+        hotqueries._hot_signatures = None
+        self.sample_rate = hotqueries.HOT_QUERY_SAMPLE_RATE
+        hotqueries.HOT_QUERY_SAMPLE_RATE = 1.0
+        add_page('liberty', 'Liberty', 'I saw the Statue of Liberty in the harbor.')
+        add_page('python', 'Python', 'Pythonic programmers test their code.')
+
+    def teardown(self):
+        hotqueries.HOT_QUERY_SAMPLE_RATE = self.sample_rate
+
+    def test_signature(self):
+        assert hotqueries.get_signature('Statue of Liberty!') == \
+               hotqueries.get_signature(' statue OF liberty')
+        assert hotqueries.get_signature('statue', kind='HotPage') != \
+               hotqueries.get_signature('statue')
+
+    def test_sampling_and_refresh(self):
+        for i in xrange(3):
+            assert len(HotPage.search('statue of liberty', keys_only=True)) == 1
+        HotPage.search('python', keys_only=True)
+        stats = hotqueries.refresh_hot_queries(top_n=1)
+        assert stats['hot'] == 1 and stats['recomputed'] == 1
+        hot_list = hotqueries.HotQuery.all().filter('materialized =', True).fetch(10)
+        assert len(hot_list) == 1
+        assert hot_list[0].phrase == 'statue of liberty'
+        assert [search.SearchIndex.get_title(key.name())
+                for key in hot_list[0].result_keys] == ['Liberty']
+
+    def test_served_from_materialized_results(self):
+        HotPage.search('statue', keys_only=True)
+        hotqueries.refresh_hot_queries()
+        # Remove the index entities; hot results don't touch them.
+        db.delete(search.StemmedIndex.all(keys_only=True).fetch(100))
+        key_list = HotPage.search('statue', keys_only=True)
+        assert len(key_list) == 1 and key_list[0][1] == 'Liberty'
+        assert not HotPage.full_text_search('statue', kind='HotPage',
+                                         use_hot_queries=False)
+
+    def test_delete_dematerializes(self):
+        HotPage.search('statue', keys_only=True)
+        hotqueries.refresh_hot_queries()
+        hot_query = hotqueries.HotQuery.all().filter('materialized =', True).get()
+        assert hot_query.result_parents == [db.Key.from_path('HotPage', 'liberty')]
+        HotPage.get_by_key_name('liberty').delete()
+        assert HotPage.search('statue', keys_only=True) == []
+        assert not hotqueries.HotQuery.all().filter('materialized =', True).count()
+
+    def test_generation_reseeded_above_previous(self):
+        generation = search.get_kind_generation('HotPage')
+        from google.appengine.api import memcache
+        memcache.flush_all()
+        assert search.get_kind_generation('HotPage') > generation
+
+    def test_refresh_on_generation_change(self):
+        HotPage.search('statue', keys_only=True)
+        stats = hotqueries.refresh_hot_queries()
+        assert stats['recomputed'] == 1
+        stats = hotqueries.refresh_hot_queries()
+        assert stats['recomputed'] == 0
+        add_page('statue2', 'Another Statue', 'A statue stands in the park.')
+        stats = hotqueries.refresh_hot_queries()
+        assert stats['recomputed'] == 1
+        assert len(HotPage.search('statue', keys_only=True)) == 2
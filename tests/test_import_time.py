@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+#
+# The MIT License
+# 
+# Copyright (c) 2009 William T. Katz
+# Website/Contact: http://www.billkatz.com
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to 
+# deal in the Software without restriction, including without limitation 
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER 
+# DEALINGS IN THE SOFTWARE.
+
+"""Import-time budget for the search package and the demo app.
+
+Each import is timed in a fresh interpreter so module caching in the
+test process doesn't hide cold-start cost.  Budgets (milliseconds) can be
+overridden for slower machines through SEARCH_IMPORT_BUDGET_MS and
+MAIN_IMPORT_BUDGET_MS.  Run this file directly to print the timings.
+"""
+
+import os
+import subprocess
+import sys
+
+SEARCH_IMPORT_BUDGET_MS = float(os.environ.get('SEARCH_IMPORT_BUDGET_MS', 250))
+MAIN_IMPORT_BUDGET_MS = float(os.environ.get('MAIN_IMPORT_BUDGET_MS', 600))
+
+# Modules that `import search` must leave unloaded.
+LAZY_MODULES = ['google.appengine.ext.webapp',
+                'google.appengine.api.labs.taskqueue',
+                'search.handlers',
+                'search.pyporter2.Stemmer']
+
+CHILD_SCRIPT = """
+import sys
+import time
+sys.path[:0] = %(path)r
+start = time.time()
+__import__(%(module)r)
+print (time.time() - start) * 1000.0
+print ' '.join(sys.modules.keys())
+"""
+
+def measure_import(module_name, runs=3):
+    """Imports module_name in fresh interpreters.
+
+    Returns:
+        A (best_ms, loaded_modules) tuple where loaded_modules is the set of
+        modules loaded in sys.modules after the import.
+    """
+    app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = CHILD_SCRIPT % {'path': [app_dir] + sys.path, 'module': module_name}
+    env = dict(os.environ)
+    env.setdefault('AUTH_DOMAIN', 'example.org')
+    best_ms = None
+    for run in xrange(runs):
+        child = subprocess.Popen([sys.executable, '-c', script], cwd=app_dir,
+                                 env=env, stdout=subprocess.PIPE)
+        output = child.communicate()[0]
+        assert child.returncode == 0, "Could not import %s" % module_name
+        elapsed, modules = output.split('\n', 1)
+        elapsed = float(elapsed)
+        if best_ms is None or elapsed < best_ms:
+            best_ms = elapsed
+    return best_ms, set(modules.split())
+
+def test_search_import_is_lazy():
+    elapsed, modules = measure_import('search')
+    for name in LAZY_MODULES:
+        assert name not in modules, "'import search' loaded %s" % name
+
+def test_search_import_budget():
+    elapsed, modules = measure_import('search')
+    assert elapsed <= SEARCH_IMPORT_BUDGET_MS, \
+           "'import search' took %.1f ms (budget %.1f ms)" % (elapsed, SEARCH_IMPORT_BUDGET_MS)
+
+def test_main_import_budget():
+    elapsed, modules = measure_import('main')
+    assert 'search.pyporter2.Stemmer' not in modules
+    assert elapsed <= MAIN_IMPORT_BUDGET_MS, \
+           "'import main' took %.1f ms (budget %.1f ms)" % (elapsed, MAIN_IMPORT_BUDGET_MS)
+
+if __name__ == '__main__':
+    for module_name, budget in [('search', SEARCH_IMPORT_BUDGET_MS),
+                                ('main', MAIN_IMPORT_BUDGET_MS)]:
+        elapsed, modules = measure_import(module_name)
+        print "import %-8s %7.1f ms  (budget %.1f ms, %d modules loaded)" % \
+              (module_name, elapsed, budget, len(modules))
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+#
+# The MIT License
+# 
+# Copyright (c) 2009 William T. Katz
+# Website/Contact: http://www.billkatz.com
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to 
+# deal in the Software without restriction, including without limitation 
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER 
+# DEALINGS IN THE SOFTWARE.
+
+
+import os
+import tempfile
+
+from tests import loadtest
+
+class TestLoadHarness:
+    def setup(self):
+        self.operations = loadtest.generate_workload(
+                              num_pages=6, words_per_page=40, num_searches=12,
+                              full_ratio=0.5, task_every=3, seed=7)
+
+    def test_generate_workload(self):
+        ops = [op['op'] for op in self.operations]
+        assert ops.count('post_page') == 6
+        assert ops.count('run_tasks') == 2
+        assert ops.count('search') == 12
+        assert ops.index('search') > ops.index('run_tasks')
+        assert self.operations == loadtest.generate_workload(
+                                      num_pages=6, words_per_page=40, num_searches=12,
+                                      full_ratio=0.5, task_every=3, seed=7)
+
+    def test_workload_file_round_trip(self):
+        handle, path = tempfile.mkstemp(suffix='.jsonl')
+        os.close(handle)
+        try:
+            loadtest.write_workload(self.operations, path)
+            assert loadtest.read_workload(path) == self.operations
+        finally:
+            os.remove(path)
+
+    def test_replay_report(self):
+        rows, wall_seconds = loadtest.run(self.operations)
+        by_op = dict([(row['op'], row) for row in rows])
+        assert by_op['post_page']['count'] == 6
+        assert by_op['run_tasks']['rpcs'] > 0
+        assert sum([row['count'] for row in rows
+                    if row['op'].startswith('search_')]) == 12
+        for row in rows:
+            assert row['p50'] <= row['p95'] <= row['p99']
+        assert 'req/sec' in loadtest.format_report(rows, wall_seconds)
+
+    def test_concurrent_replay(self):
+        rows, wall_seconds = loadtest.run(self.operations, concurrency=3)
+        assert sum([row['count'] for row in rows]) == len(self.operations)
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+#
+# The MIT License
+# 
+# Copyright (c) 2009 William T. Katz
+# Website/Contact: http://www.billkatz.com
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to 
+# deal in the Software without restriction, including without limitation 
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER 
+# DEALINGS IN THE SOFTWARE.
+
+
+from google.appengine.api import datastore
+from google.appengine.ext import db
+import search
+from search import maintenance
+
+from tests.test_search import clear_datastore
+
+class SweepPage(search.Searchable, db.Model):
+    content = db.TextProperty()
+
+class DedicatedPage(search.Searchable, db.Model):
+    content = db.TextProperty()
+    INDEX_DEDICATED = True
+
+class MigratingPage(search.Searchable, db.Model):
+    content = db.TextProperty()
+
+class SwitchingPage(search.Searchable, db.Model):
+    content = db.TextProperty()
+
+def add_pages(num_pages):
+    pages = []
+    for i in xrange(num_pages):
+        page = SweepPage(key_name='page%d' % i, content='Sweeping page number %d' % i)
+        page.put()
+        page.index()
+        pages.append(page)
+    return pages
+
+class TestUnindex:
+    def setup(self):
+        clear_datastore()
+
+    def test_delete_unindexes(self):
+        pages = add_pages(2)
+        pages[0].delete()
+        assert search.StemmedIndex.all().count() == 1
+        assert len(SweepPage.search('sweeping')) == 1
+
+    def test_unindex_key(self):
+        pages = add_pages(2)
+        key = pages[1].key()
+        db.delete(key)
+        SweepPage.unindex_key(key)
+        assert search.StemmedIndex.all().count() == 1
+
+class TestOrphanSweep:
+    def setup(self):
+        clear_datastore()
+        self.pages = add_pages(5)
+        db.delete([page.key() for page in self.pages[1:4]])
+
+    def test_search_skips_orphans(self):
+        pages = SweepPage.search('sweeping')
+        assert len(pages) == 2
+        assert None not in pages
+
+    def test_resumable_sweep(self):
+        stats = maintenance.sweep_orphans(search.StemmedIndex, batch_size=2)
+        assert stats['scanned'] == 2 and stats['next_key']
+        totals = stats['orphans']
+        while stats['next_key']:
+            stats = maintenance.sweep_orphans(search.StemmedIndex,
+                                              stats['next_key'], batch_size=2)
+            totals += stats['orphans']
+        assert totals == 3
+        assert search.StemmedIndex.all().count() == 2
+
+    def test_sweep_all(self):
+        # Each page has one index entity and one IndexHead.
+        totals = maintenance.sweep_all_orphans()
+        assert totals['scanned'] == 10 and totals['orphans'] == 6
+        totals = maintenance.sweep_all_orphans()
+        assert totals['scanned'] == 4 and totals['orphans'] == 0
+
+    def test_unimported_parent_kind(self):
+        for key_name in ['kept', 'deleted']:
+            parent = datastore.Entity('UnimportedPage', name=key_name)
+            datastore.Put(parent)
+            search.StemmedIndex(key_name=key_name, parent=parent.key(),
+                                parent_kind='UnimportedPage',
+                                phrases=['unimported']).put()
+        datastore.Delete(db.Key.from_path('UnimportedPage', 'deleted'))
+        totals = maintenance.sweep_all_orphans()
+        assert totals['orphans'] == 7
+        assert [key.parent().name() for key in search.StemmedIndex.all(keys_only=True)
+                if key.parent().kind() == 'UnimportedPage'] == ['kept']
+
+    def test_heads_swept(self):
+        assert search.IndexHead.all().count() == 5
+        stats = maintenance.sweep_orphans(search.IndexHead)
+        assert stats['orphans'] == 3
+        remaining = [head.parent_key().name() for head in search.IndexHead.all()]
+        assert sorted(remaining) == ['page0', 'page4']
+
+class TestPartitioning:
+    def test_partition_phrases(self):
+        phrases = ['phrase %d' % i for i in xrange(40)]
+        shards = search.partition_phrases(phrases, max_phrases=10)
+        assert sum([len(shard) for shard in shards]) == 40
+        assert max([len(shard) for shard in shards]) <= 10
+        assert shards == search.partition_phrases(list(reversed(phrases)),
+                                                  max_phrases=10)
+
+    def test_edit_touches_one_shard(self):
+        phrases = ['phrase %d' % i for i in xrange(40)]
+        before = search.partition_phrases(phrases, max_phrases=10)
+        after = search.partition_phrases(phrases + ['new phrase'], max_phrases=10)
+        assert len(before) == len(after)
+        assert len([1 for old, new in zip(before, after) if old != new]) == 1
+
+class TestCompaction:
+    def setup(self):
+        clear_datastore()
+        self.page = add_pages(1)[0]
+        # Simulate drift: phrases spread over extra, overlapping shards.
+        index = search.StemmedIndex.all().get()
+        for index_num in [2, 3]:
+            search.StemmedIndex.put_index(self.page, index.phrases[:2], index_num,
+                                          version=index.version)
+        assert search.StemmedIndex.all().count() == 3
+
+    def test_compact_index(self):
+        stats = self.page.compact_index()
+        assert stats['entities_before'] == 3 and stats['entities_after'] == 1
+        assert stats['bytes_after'] < stats['bytes_before']
+        assert search.StemmedIndex.all().count() == 1
+        assert len(SweepPage.search('sweeping')) == 1
+        stats = self.page.compact_index()
+        assert stats['written'] == 0
+
+    def test_stale_shards_dropped(self):
+        search.StemmedIndex.put_index(self.page, ['stale phrase'], 4, version=1)
+        stats = self.page.compact_index()
+        assert stats['entities_before'] == 4 and stats['entities_after'] == 1
+        index = search.StemmedIndex.all().ancestor(self.page.key()).get()
+        assert 'stale phrase' not in index.phrases
+
+    def test_single_full_shard_kept(self):
+        page = add_pages(2)[1]
+        max_phrases = search.get_max_shard_phrases({})
+        phrases = ['phrase %d' % i for i in xrange(max_phrases - 1)]
+        search.StemmedIndex.put_index(page, phrases, version=1)
+        stats = page.compact_index()
+        assert stats['written'] == 0 and stats['entities_after'] == 1
+        assert search.StemmedIndex.all().ancestor(page.key()).count() == 1
+
+    def test_compact_shards(self):
+        add_pages(3)    # Rewrites page0 as well.
+        version = search.StemmedIndex.all().get().version
+        for index_num in [2, 3]:
+            search.StemmedIndex.put_index(self.page, ['sweep'], index_num,
+                                          version=version)
+        stats = maintenance.compact_shards(search.StemmedIndex, batch_size=2)
+        totals = stats['entities_reclaimed']
+        while stats['next_key']:
+            stats = maintenance.compact_shards(search.StemmedIndex,
+                                               stats['next_key'], batch_size=2)
+            totals += stats['entities_reclaimed']
+        assert totals == 2
+        assert search.StemmedIndex.all().count() == 3
+
+class TestDedicatedIndex:
+    def setup(self):
+        clear_datastore()
+        search._recorded_index_classes.clear()
+
+    def test_index_and_search(self):
+        page = DedicatedPage(key_name='page', content='Dedicated tables')
+        page.put()
+        page.index()
+        index_class = DedicatedPage.get_index_class()
+        assert index_class.kind() == 'DedicatedPageStemmedIndex'
+        assert search.StemmedIndex.all().count() == 0
+        index = index_class.all().get()
+        assert 'parent_kind' not in index.properties()
+        assert [page.key().name() for page in DedicatedPage.search('tables')] == ['page']
+        assert search.Searchable.full_text_search('tables', kind='DedicatedPage',
+                                                  use_hot_queries=False)
+        page.delete()
+        assert index_class.all().count() == 0
+
+    def test_shard_capacity(self):
+        assert search.get_max_shard_phrases({}, dedicated=True) == \
+               search.MAX_ENTITY_SEARCH_PHRASES
+        assert search.get_max_shard_phrases({'sort_value': 1}, dedicated=True) == \
+               search.MAX_ENTITY_SEARCH_PHRASES
+
+    def test_maintenance_classes(self):
+        page = DedicatedPage(key_name='orphan', content='Dedicated orphan')
+        page.put()
+        page.index()
+        index_class = DedicatedPage.get_index_class()
+        record = search.DedicatedIndexRecord.get_by_key_name(index_class.kind())
+        assert record.parent_kind == 'DedicatedPage' and record.stemming
+        assert index_class in maintenance.get_index_classes()
+        assert maintenance.get_index_class(index_class.kind()) is index_class
+        db.delete(page.key())
+        assert maintenance.sweep_orphans(index_class)['orphans'] == 1
+
+    def test_migration(self):
+        for i in xrange(3):
+            page = MigratingPage(key_name='page%d' % i, content='Migrating page %d' % i)
+            page.put()
+            page.index(version=10 + i)
+        MigratingPage.INDEX_DEDICATED = True
+        try:
+            # Both index models are read until the migration is complete.
+            assert len(MigratingPage.search('migrating')) == 3
+            stats = maintenance.migrate_to_dedicated(MigratingPage, batch_size=2)
+            assert (stats['scanned'], stats['migrated']) == (2, 2)
+            assert len(MigratingPage.search('migrating')) == 3
+            assert not search.is_migration_complete('MigratingPage')
+            stats = maintenance.migrate_to_dedicated(MigratingPage, stats['next_key'],
+                                                     batch_size=2)
+            assert stats['migrated'] == 1 and stats['next_key'] is None
+            assert search.is_migration_complete('MigratingPage')
+            assert search.get_search_index_classes('MigratingPage') == \
+                   [MigratingPage.get_index_class()]
+            assert search.StemmedIndex.all().count() == 0
+            assert len(MigratingPage.search('migrating')) == 3
+            # Versions carry over, so stale indexing is still skipped
+            page = MigratingPage.get_by_key_name('page2')
+            assert not page.index(version=11)
+        finally:
+            MigratingPage.INDEX_DEDICATED = False
+
+    def test_reindex_during_migration(self):
+        for i in xrange(2):
+            page = SwitchingPage(key_name='page%d' % i, content='Switching page %d' % i)
+            page.put()
+            page.index(version=10)
+        SwitchingPage.INDEX_DEDICATED = True
+        try:
+            page = SwitchingPage.get_by_key_name('page0')
+            page.content = 'Rewritten page'
+            page.index(version=11)
+            assert search.StemmedIndex.all().ancestor(page.key()).count() == 0
+            assert search.IndexHead.get_by_key_name(
+                       search.StemmedIndex.kind(), parent=page) is None
+            assert [p.key().name() for p in SwitchingPage.search('switching')] == \
+                   ['page1']
+            SwitchingPage.get_by_key_name('page1').delete()
+            assert search.StemmedIndex.all().count() == 0
+            assert not SwitchingPage.search('switching')
+        finally:
+            SwitchingPage.INDEX_DEDICATED = False
+
+    def test_migration_needs_dedicated(self):
+        try:
+            maintenance.migrate_to_dedicated(MigratingPage)
+        except search.Error:
+            pass
+        else:
+            assert False, 'search.Error not raised'
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# The MIT License
+# 
+# Copyright (c) 2009 William T. Katz
+# Website/Contact: http://www.billkatz.com
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to 
+# deal in the Software without restriction, including without limitation 
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER 
+# DEALINGS IN THE SOFTWARE.
+
+
+
+import array
+
+from google.appengine.ext import db
+import search
+from search import postings
+
+from tests.test_search import clear_datastore
+
+class PostedPage(search.Searchable, db.Model):
+    title = db.StringProperty()
+    content = db.TextProperty()
+    INDEX_TITLE_FROM_PROP = 'title'
+    INDEX_MULTI_WORD = False
+
+def add_page(title, content):
+    page = PostedPage(title=title, content=content)
+    page.put()
+    page.index()
+    return page.key().id()
+
+def warm(terms):
+    """Searches each term until its postings are cached."""
+    for term in terms:
+        for i in xrange(postings.HOT_TERM_QUERIES):
+            PostedPage.search(term, keys_only=True)
+
+class TestPostings:
+    def setup(self):
+        clear_datastore()
+        self.ids = [add_page('Snakes', 'Python snakes'),
+                    add_page('Scripts', 'Python scripts'),
+                    add_page('Ruby', 'Ruby scripts')]
+
+    def test_not_cached_until_hot(self):
+        PostedPage.search('python', keys_only=True)
+        assert postings.get_cache_size()[0] == 0
+        warm(['python'])
+        assert postings.get_cache_size()[0] == 1
+
+    def test_cached_intersection(self):
+        warm(['python', 'scripts'])
+        key_list = PostedPage.search('python scripts', keys_only=True)
+        assert [(key.id(), title) for key, title in key_list] == [(self.ids[1], 'Scripts')]
+
+    def test_missing_terms(self):
+        warm(['scripts'])
+        key_list = PostedPage.search('ruby scripts', keys_only=True)
+        assert [key.id() for key, title in key_list] == [self.ids[2]]
+
+    def test_compact_ids(self):
+        warm(['scripts'])
+        stemmed = search.get_stemmer().stemWord('scripts')
+        cached = postings.get_postings(search.StemmedIndex, 'PostedPage', stemmed,
+                                       search.get_kind_generation('PostedPage'))
+        assert isinstance(cached.ids, array.array)
+        assert list(cached.ids) == sorted(self.ids[1:])
+
+    def test_generation_invalidates(self):
+        warm(['python'])
+        new_id = add_page('More', 'More python')
+        key_list = PostedPage.search('python', keys_only=True)
+        assert sorted([key.id() for key, title in key_list]) == \
+               sorted([self.ids[0], self.ids[1], new_id])
+
+    def test_memory_budget(self):
+        old_budget = postings.POSTINGS_MEMORY_BUDGET
+        try:
+            warm(['python'])
+            postings.POSTINGS_MEMORY_BUDGET = postings.get_cache_size()[1] + 1
+            warm(['scripts'])
+            assert postings.get_cache_size()[0] == 1
+        finally:
+            postings.POSTINGS_MEMORY_BUDGET = old_budget
+
+    def test_intersect(self):
+        first = postings.Postings(array.array('l', [1, 3, 5, 7, 7]),
+                                  ('a', 'b', 'c', 'd1', 'd2'), 0)
+        second = postings.Postings(array.array('l', [3, 7, 7, 9]),
+                                   ('b', 'd2', 'd3', 'e'), 0)
+        # Entity 7 has the terms in separate index entities except d2.
+        assert postings.intersect([first, second]) == [(3, 'b'), (7, 'd2')]
+
+    def test_shards_intersected_separately(self):
+        words = ['word%d' % i for i in xrange(search.MAX_ENTITY_SEARCH_PHRASES)]
+        page_key = db.Key.from_path('PostedPage', add_page('Big', ' '.join(words)))
+        shards = search.StemmedIndex.all().ancestor(page_key).fetch(1000)
+        assert len(shards) > 1
+        same_shard = shards[0].phrases[:2]
+        split = [shards[0].phrases[0], shards[1].phrases[0]]
+        for terms, expected in [(same_shard, 1), (split, 0)]:
+            phrase = ' '.join(terms)
+            uncached = search.Searchable.search_index_keys(
+                phrase, kind='PostedPage', multi_word_literal=False,
+                use_hot_queries=False, use_postings=False)
+            warm(terms)
+            cached = search.Searchable.search_index_keys(
+                phrase, kind='PostedPage', multi_word_literal=False,
+                use_hot_queries=False)
+            assert postings.get_cache_size()[0] >= 2
+            assert cached == uncached
+            assert len(cached) == expected
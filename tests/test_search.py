@@ -23,6 +23,7 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER 
 # DEALINGS IN THE SOFTWARE.
 
+import datetime
 import re
 import os
 
@@ -47,14 +48,19 @@ in ornately narrated prose doomed to be read only by
 computerized algorithms implementing text processing!
 """
 
+from google.appengine.api import users
 from google.appengine.ext import db
 import search
+from search import postings
 
 from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import datastore_file_stub
+from google.appengine.api.memcache import memcache_stub
+
+from tests.loadtest import CountingStub
 
 def clear_datastore():
-    """Clear datastore.  Can be used between tests to insure empty datastore.
+    """Clear datastore, memcache and cached postings.  Can be used between tests to insure empty datastore.
     
     See code.google.com/p/nose-gae/issues/detail?id=16
     Note: the appid passed to DatastoreFileStub should match the app id in your app.yaml.
@@ -62,6 +68,8 @@ def clear_datastore():
     apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
     stub = datastore_file_stub.DatastoreFileStub('billkatz-test', '/dev/null', '/dev/null')
     apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub)
+    apiproxy_stub_map.apiproxy.RegisterStub('memcache', memcache_stub.MemcacheServiceStub())
+    postings.clear()
 
 class Page(search.Searchable, db.Model):
     author_name = db.StringProperty()
@@ -76,6 +84,41 @@ class NoninflectedPage(search.Searchable, db.Model):
     INDEX_STEMMING = False
     INDEX_ONLY = ['content']
 
+class StoredPage(search.Searchable, db.Model):
+    """Used to test results built from INDEX_STORED_FIELDS"""
+    title = db.StringProperty()
+    author_name = db.StringProperty()
+    rating = db.IntegerProperty()
+    created = db.DateTimeProperty()
+    content = db.TextProperty()
+    INDEX_TITLE_FROM_PROP = 'title'
+    INDEX_STORED_FIELDS = ['author_name', 'rating', 'created']
+    INDEX_USES_MULTI_ENTITIES = False
+
+class VersionedPage(search.Searchable, db.Model):
+    """Used to test version-stamped indexing"""
+    content = db.TextProperty()
+    version = db.IntegerProperty()
+    INDEX_VERSION_FROM_PROP = 'version'
+
+class SortedPage(search.Searchable, db.Model):
+    """Used to test searches ordered by INDEX_SORT_PROP"""
+    content = db.TextProperty()
+    rank = db.IntegerProperty()
+    INDEX_SORT_PROP = 'rank'
+
+class FilteredPage(search.Searchable, db.Model):
+    """Used to test searches filtered on INDEX_FILTER_PROPS
+
+    Deployed, it would need filter_author and filter_rank indexes with
+    sort_value like the filter_user ones in index.yaml.
+    """
+    content = db.TextProperty()
+    author = db.StringProperty()
+    rank = db.IntegerProperty()
+    INDEX_FILTER_PROPS = ['author', 'rank']
+    INDEX_SORT_PROP = 'rank'
+
 class TestMisc:
     def setup(self):
         clear_datastore()
@@ -86,6 +129,10 @@ class TestMisc:
         key = page.put()
         assert str(key.name()) == "Show Don't Tell"
 
+    def test_search_indexing_alias(self):
+        from search import handlers
+        assert isinstance(search.SearchIndexing(), handlers.SearchIndexing)
+
 class TestLoremIpsum:
     def setup(self):
         clear_datastore()
@@ -274,4 +321,327 @@ class TestMultiWordSearch:
         assert len(returned_pages) == 1
         assert returned_pages[0].key().name() == u'doetext'
 
-     
\ No newline at end of file
+     
+class TestStoredFields:
+    def setup(self):
+        clear_datastore()
+        self.created = datetime.datetime(2009, 7, 16, 12, 30, 15, 250)
+        page = StoredPage(key_name='stored', title='Stored, Fields || Page',
+                          author_name=u'J\xf6rg, 100%', rating=5,
+                          created=self.created, content=INFLECTION_TEST)
+        page.put()
+        page.index()
+
+    def test_stored_only_search(self):
+        results = StoredPage.search('pythonic', stored_only=True)
+        assert len(results) == 1
+        result = results[0]
+        assert result.key.name() == 'stored'
+        assert result.title == 'Stored, Fields || Page'
+        assert result.author_name == u'J\xf6rg, 100%'
+        assert result.rating == 5
+        assert result.created == self.created
+
+    def test_stored_fields_changed(self):
+        old_fields = StoredPage.INDEX_STORED_FIELDS
+        StoredPage.INDEX_STORED_FIELDS = ['rating', 'author_name', 'created']
+        try:
+            result = StoredPage.search('pythonic', stored_only=True)[0]
+            assert result.title == 'Stored, Fields || Page'
+            assert result.fields == {}
+        finally:
+            StoredPage.INDEX_STORED_FIELDS = old_fields
+
+    def test_user_value(self):
+        user = users.User(u'j\xf6rg/x@example.org', _auth_domain='example.org')
+        decoded = search._decode_stored_value(search._encode_stored_value(user))
+        assert decoded.email() == user.email()
+        assert decoded.auth_domain() == 'example.org'
+        if hasattr(user, 'user_id'):
+            assert decoded.user_id() == user.user_id()
+
+    def test_missing_value(self):
+        page = StoredPage(key_name='unrated', content='Unrated pythonic prose.')
+        page.put()
+        page.index()
+        results = StoredPage.search('prose', stored_only=True)
+        assert len(results) == 1
+        assert results[0].rating is None
+        assert results[0].title == 'StoredPage unrated'
+
+    def test_reindex_replaces_key_name(self):
+        page = StoredPage.get_by_key_name('stored')
+        page.rating = 3
+        page.put()
+        page.index()
+        assert search.StemmedIndex.all().count() == 1
+        assert StoredPage.search('pythonic', stored_only=True)[0].rating == 3
+
+    def test_too_long(self):
+        page = StoredPage(key_name='long', author_name='x' * 490, content='Long')
+        page.put()
+        try:
+            page.index()
+        except search.StoredFieldsError:
+            pass
+        else:
+            assert False, 'StoredFieldsError not raised'
+
+class TestVersionedIndexing:
+    def setup(self):
+        clear_datastore()
+        self.old_page = VersionedPage(key_name='versioned', version=1,
+                                      content='The original pythonic text.')
+        self.old_page.put()
+        self.new_page = VersionedPage(key_name='versioned', version=2,
+                                      content='Rewritten with encrusted rubies.')
+        self.new_page.put()
+        assert self.new_page.index()
+
+    def test_stale_run_writes_nothing(self):
+        assert not self.old_page.index()
+        assert not VersionedPage.search('pythonic')
+        assert VersionedPage.search('rubies')
+        assert search.StemmedIndex.all().get().version == 2
+
+    def test_same_version_skipped(self):
+        assert not self.new_page.index()
+        assert self.new_page.index(force=True)
+        assert search.StemmedIndex.all().count() == 1
+
+    def test_version_checked_in_transaction(self):
+        head = search.IndexHead(key_name='StemmedIndex', parent=self.new_page.key(),
+                                version=3)
+        head.put()
+        self.new_page.content = 'Newer words about serpentine mascots.'
+        assert not self.new_page.index(force=True)
+        assert not VersionedPage.search('serpentine')
+
+    def test_unindex_removes_head(self):
+        self.new_page.delete()
+        assert search.IndexHead.all().count() == 0
+
+    def test_unchanged_shards_kept(self):
+        words = ['word%d' % i for i in xrange(search.MAX_ENTITY_SEARCH_PHRASES)]
+        page = VersionedPage(key_name='big', version=1, content=' '.join(words))
+        page.put()
+        page.index()
+        page.version = 2
+        page.content += ' addendum'
+        page.index()
+        shards = search.StemmedIndex.all().ancestor(page.key()).fetch(1000)
+        assert len(shards) > 3
+        # The new word adds at most three phrases, so other shards are kept.
+        rewritten = [shard for shard in shards if shard.version == 2]
+        assert 0 < len(rewritten) < len(shards)
+        assert len(VersionedPage.search('addendum')) == 1
+
+class TestSortedSearch:
+    def setup(self):
+        clear_datastore()
+        for key_name, rank in [('middle', 2), ('low', 1), ('high', 3)]:
+            page = SortedPage(key_name=key_name, rank=rank,
+                              content='Pythonic %s ranked page.' % key_name)
+            page.put()
+            page.index()
+        page = SortedPage(key_name='other', rank=4, content='Unrelated words.')
+        page.put()
+        page.index()
+
+    def test_descending(self):
+        pages = SortedPage.search('pythonic page', order='-rank')
+        assert [page.key().name() for page in pages] == ['high', 'middle', 'low']
+
+    def test_ascending_limit(self):
+        key_list = SortedPage.search('pythonic', limit=2, keys_only=True, order='rank')
+        assert [key.name() for key, title in key_list] == ['low', 'middle']
+
+    def test_sort_value_copied(self):
+        index = search.StemmedIndex.all().ancestor(db.Key.from_path('SortedPage', 'high')).get()
+        assert index.sort_value == 3
+        page = SortedPage.get_by_key_name('high')
+        page.rank = 0
+        page.put()
+        page.index()
+        pages = SortedPage.search('pythonic', order='-rank')
+        assert [page.key().name() for page in pages] == ['middle', 'low', 'high']
+
+    def test_unsorted_kinds_have_no_sort_value(self):
+        page = Page(key_name='plain', content=INFLECTION_TEST)
+        page.put()
+        page.index()
+        index = search.StemmedIndex.all().ancestor(page.key()).get()
+        assert 'sort_value' not in index.dynamic_properties()
+
+    def test_bad_order(self):
+        try:
+            SortedPage.search('pythonic', order='-content')
+        except search.IndexSortError:
+            pass
+        else:
+            assert False, 'IndexSortError not raised'
+
+class TestFilteredSearch:
+    def setup(self):
+        clear_datastore()
+        for key_name, author, rank in [('a1', 'ann', 1), ('b2', 'bob', 2),
+                                       ('a3', 'ann', 3), ('b4', 'bob', 4)]:
+            page = FilteredPage(key_name=key_name, author=author, rank=rank,
+                                content='Pythonic page number %d.' % rank)
+            page.put()
+            page.index()
+
+    def test_filter_values_copied(self):
+        index = search.StemmedIndex.all().ancestor(db.Key.from_path('FilteredPage', 'b2')).get()
+        assert index.filter_author == 'bob'
+        assert index.filter_rank == 2
+
+    def test_equality_filter(self):
+        key_list = FilteredPage.search('pythonic page', keys_only=True,
+                                       filters=[('author =', 'ann')])
+        assert sorted([key.name() for key, title in key_list]) == ['a1', 'a3']
+
+    def test_equality_filter_with_order(self):
+        pages = FilteredPage.search('pythonic', order='-rank',
+                                    filters=[('author', 'bob')])
+        assert [page.key().name() for page in pages] == ['b4', 'b2']
+
+    def test_range_filter(self):
+        key_list = FilteredPage.search('pythonic', keys_only=True,
+                                       filters=[('rank >', 1), ('rank <=', 3),
+                                                ('author =', 'ann')])
+        assert [key.name() for key, title in key_list] == ['a3']
+
+    def test_filter_value_changed(self):
+        page = FilteredPage.get_by_key_name('a1')
+        page.author = 'bob'
+        page.put()
+        page.index()
+        key_list = FilteredPage.search('pythonic', keys_only=True,
+                                       filters=[('author =', 'ann')])
+        assert [key.name() for key, title in key_list] == ['a3']
+
+    def test_full_text_search_filters(self):
+        results = search.Searchable.full_text_search(
+                    'pythonic', filters=[('author =', 'bob')])
+        assert sorted([key.name() for key, title in results]) == ['b2', 'b4']
+
+    def test_multi_keyword_range_filter(self):
+        key_list = FilteredPage.search('pythonic number', keys_only=True,
+                                       filters=[('rank >=', 2), ('author =', 'bob')])
+        assert sorted([key.name() for key, title in key_list]) == ['b2', 'b4']
+
+    def test_range_filter_with_order(self):
+        pages = FilteredPage.search('pythonic', order='-rank',
+                                    filters=[('rank >', 1)])
+        assert [page.key().name() for page in pages] == ['b4', 'a3', 'b2']
+
+    def test_shard_capacity(self):
+        # parent_kind and sort_value; filter values aren't in phrase composites
+        assert search.get_max_shard_phrases(
+                    FilteredPage(rank=1).get_index_values()) == \
+               search.MAX_ENTITY_SEARCH_PHRASES / 2
+
+    def test_bad_filters(self):
+        for phrase, filters in [('pythonic', [('content =', 'x')]),
+                                ('pythonic', [('rank !=', 1)]),
+                                ('pythonic', [('author >', 'a')])]:
+            try:
+                FilteredPage.search(phrase, filters=filters)
+            except search.IndexFilterError:
+                pass
+            else:
+                assert False, 'IndexFilterError not raised for %s' % filters
+
+class TestMultiKindSearch:
+    def setup(self):
+        clear_datastore()
+        for num in range(3):
+            page = Page(key_name='page%d' % num, content='Pythonic page %d.' % num)
+            page.put()
+            page.index()
+        page = SortedPage(key_name='sorted', rank=1, content='A pythonic ranked page.')
+        page.put()
+        page.index()
+        page = FilteredPage(key_name='filtered', author='ann', rank=1,
+                            content='Unrelated words.')
+        page.put()
+        page.index()
+
+    def test_merged_results(self):
+        results, facets = search.Searchable.multi_kind_search(
+                            'pythonic', ['Page', 'SortedPage', 'FilteredPage'], limit=3)
+        kinds = [key.kind() for key, title in results]
+        assert len(results) == 3
+        assert 'SortedPage' in kinds
+        assert 'FilteredPage' not in kinds
+
+    def test_facets(self):
+        results, facets = search.Searchable.multi_kind_search(
+                            'pythonic page', ['Page', 'SortedPage', 'FilteredPage'], limit=2)
+        assert facets == {'Page': 3, 'SortedPage': 1, 'FilteredPage': 0}
+
+    def test_unknown_kind(self):
+        try:
+            search.Searchable.multi_kind_search('pythonic', ['Page', 'NoSuchPage'])
+        except db.KindError:
+            pass
+        else:
+            assert False, 'db.KindError not raised'
+
+    def test_facet_limit(self):
+        results, facets = search.Searchable.multi_kind_search(
+                            'pythonic', ['Page'], limit=1, facet_limit=2)
+        assert len(results) == 1
+        assert facets == {'Page': 2}
+
+class PutSizeStub(CountingStub):
+    """Counts datastore calls and records the size of each put request."""
+    def MakeSyncCall(self, service, call, request, response):
+        if call == 'Put':
+            self.put_sizes.append(request.ByteSize())
+        return CountingStub.MakeSyncCall(self, service, call, request, response)
+
+    def reset(self):
+        CountingStub.reset(self)
+        self.put_sizes = []
+
+class TestBatchedWrites:
+    def setup(self):
+        clear_datastore()
+        # A stub can only be registered once per map, so wrap the fresh
+        # stubs in a new map.
+        stubs = apiproxy_stub_map.apiproxy
+        self.datastore = PutSizeStub(stubs.GetStub('datastore_v3'))
+        self.datastore.reset()
+        apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+        apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', self.datastore)
+        apiproxy_stub_map.apiproxy.RegisterStub('memcache', stubs.GetStub('memcache'))
+
+    def count_index_calls(self, page):
+        page.put()
+        self.datastore.reset()
+        page.index()
+        return self.datastore.count()
+
+    def test_calls_independent_of_shards(self):
+        small = NoninflectedPage(key_name='small', content='Just a few words.')
+        words = ['word%d' % i for i in xrange(search.MAX_ENTITY_SEARCH_PHRASES)]
+        big = NoninflectedPage(key_name='big', content=' '.join(words))
+        small_calls = self.count_index_calls(small)
+        big_calls = self.count_index_calls(big)
+        assert search.LiteralIndex.all().ancestor(big.key()).count() > 2
+        assert small_calls > 0 and big_calls == small_calls
+
+    def test_puts_split_by_size(self):
+        words = ['%s%d' % ('longword' * 5, i)
+                 for i in xrange(search.MAX_ENTITY_SEARCH_PHRASES)]
+        big = NoninflectedPage(key_name='big', content=' '.join(words))
+        self.count_index_calls(big)
+        shards = search.LiteralIndex.all().ancestor(big.key()).fetch(1000)
+        shard_bytes = sum([len(db.model_to_protobuf(shard).Encode())
+                           for shard in shards])
+        assert shard_bytes > search.MAX_PUT_BATCH_BYTES
+        assert len(self.datastore.put_sizes) > 1
+        assert max(self.datastore.put_sizes) < 1024 * 1024
+        assert len(NoninflectedPage.search('%s0' % ('longword' * 5))) == 1
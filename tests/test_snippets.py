@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+#
+# The MIT License
+# 
+# Copyright (c) 2009 William T. Katz
+# Website/Contact: http://www.billkatz.com
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to 
+# deal in the Software without restriction, including without limitation 
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER 
+# DEALINGS IN THE SOFTWARE.
+
+
+from google.appengine.ext import db
+import search
+from search import snippets
+
+from tests.test_search import INFLECTION_TEST
+
+class SnippetPage(search.Searchable, db.Model):
+    title = db.StringProperty()
+    content = db.TextProperty()
+
+class TestPhraseMatcher:
+    def test_stemmed_matches(self):
+        matcher = snippets.PhraseMatcher('encrusting algorithm')
+        found = [INFLECTION_TEST[start:end] for start, end, terms
+                 in matcher.iter_matches(INFLECTION_TEST)]
+        assert 'algorithms' in found
+        assert 'encrusted' in found
+
+    def test_stop_words_ignored(self):
+        matcher = snippets.PhraseMatcher('the of and')
+        assert not list(matcher.iter_matches(INFLECTION_TEST))
+
+    def test_phrase_scores_best(self):
+        text = 'A statue stands here. ' + 'Filler text. ' * 40 + \
+               'Inscribed on the Statue of Liberty.'
+        matcher = snippets.PhraseMatcher('statue of liberty', stemming=False)
+        result = matcher.get_snippets([text], max_snippets=1, length=60)
+        assert len(result) == 1
+        assert '<b>Statue of Liberty</b>' in result[0]
+
+    def test_escaping(self):
+        matcher = snippets.PhraseMatcher('bold', stemming=False)
+        result = matcher.get_snippets(['<b>bold</b> & brash'])
+        assert result == ['&lt;b&gt;<b>bold</b>&lt;/b&gt; &amp; brash']
+
+    def test_snippet_limits(self):
+        text = ' '.join((['python'] + ['filler'] * 200) * 10)
+        matcher = snippets.PhraseMatcher('python', stemming=False)
+        result = matcher.get_snippets([text], max_snippets=3, length=100)
+        assert len(result) == 3
+        for snippet in result:
+            assert len(snippet) < 100 + len('<b></b>......')
+
+    def test_no_match_returns_start(self):
+        matcher = snippets.PhraseMatcher('nowhere')
+        assert matcher.get_snippets(['', 'Short text.']) == ['Short text.']
+
+class TestEntitySnippets:
+    def test_get_snippets(self):
+        page = SnippetPage(title='Guido', content=INFLECTION_TEST)
+        result = page.get_snippets('pythonic', prop_names=['content'])
+        assert len(result) == 1
+        assert '<b>pythonic</b>' in result[0]
+        assert len(result[0]) < len(INFLECTION_TEST)